@@ -28,20 +28,27 @@ $/LicenseInfo$
 """
 
 from collections import namedtuple, defaultdict
+import concurrent.futures
+import contextlib
 import subprocess
 import errno
 import filecmp
 import fnmatch
 import getopt
-import glob
+import hashlib
 import itertools
+import json
 import operator
 import os
 import re
 import shutil
+import stat
+import struct
 import subprocess
 import sys
 import tarfile
+import threading
+import time
 
 class ManifestError(RuntimeError):
     """Use an exception more specific than generic Python RuntimeError"""
@@ -63,6 +70,344 @@ def path_ancestors(path):
         path, sub = os.path.split(path)
     return result
 
+# ioctl request number for the Linux FICLONE reflink operation
+FICLONE = 0x40049409
+
+# errno values meaning "this filesystem (or OS) can't do that", as opposed to
+# a genuine failure to copy
+UNSUPPORTED_ERRNOS = frozenset(getattr(errno, name) for name in
+                               ('EOPNOTSUPP', 'ENOTSUP', 'EXDEV', 'EINVAL', 'ENOTTY',
+                                'ENOSYS', 'EPERM', 'EMLINK')
+                               if hasattr(errno, name))
+
+# Does this platform's filesystem usually ignore case in file names? If so, a
+# name missing from an os.scandir() listing might still exist.
+CASE_INSENSITIVE_FS = os.path.normcase('A') == 'a' or sys.platform == 'darwin'
+
+GLOB_MAGIC = re.compile('[*?[]')
+
+def reflink_file(src, dst):
+    """ Create dst as a copy-on-write clone of src, sharing its data blocks.
+    Raises OSError if the platform or filesystem can't do that."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.ENOSYS, "reflinks not supported on this platform", src)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+def range_copy_file(src, dst):
+    """ Copy src to dst with os.copy_file_range(), so the data never passes
+    through user space. Raises OSError if the platform can't do that."""
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        raise OSError(errno.ENOSYS, "copy_file_range() not supported on this platform", src)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                break
+            remaining -= copied
+    shutil.copystat(src, dst)
+
+# Offsets and sizes of the ELF header and section header fields we need,
+# by EI_CLASS (1: 32-bit, 2: 64-bit). See the System V ABI.
+ELF_LAYOUTS = {
+    # (e_shoff format, offset), e_shentsize offset, (section header: sh_offset
+    # and sh_size format, offset)
+    1: (('I', 0x20), 0x2E, ('II', 0x10)),
+    2: (('Q', 0x28), 0x3A, ('QQ', 0x18)),
+    }
+
+def elf_section_names(path):
+    """
+    The names of the sections in ELF file path, read from its section
+    headers without loading the rest of it; or None if path isn't an ELF
+    file (or is too mangled to parse).
+    """
+    try:
+        with open(path, 'rb') as f:
+            ident = f.read(64)
+            if len(ident) < 52 or ident[:4] != b'\x7fELF' or ident[4] not in ELF_LAYOUTS:
+                return None
+            order = {1: '<', 2: '>'}.get(ident[5])
+            if order is None:
+                return None
+            (shoff_fmt, shoff_at), shentsize_at, (sh_fmt, sh_at) = ELF_LAYOUTS[ident[4]]
+            shoff, = struct.unpack_from(order + shoff_fmt, ident, shoff_at)
+            shentsize, shnum, shstrndx = struct.unpack_from(order + 'HHH', ident, shentsize_at)
+            if not shoff:
+                return []
+
+            def header(index):
+                f.seek(shoff + index * shentsize)
+                data = f.read(shentsize)
+                if len(data) < shentsize:
+                    raise struct.error("truncated section header")
+                name, = struct.unpack_from(order + 'I', data, 0)
+                offset, size = struct.unpack_from(order + sh_fmt, data, sh_at)
+                return name, offset, size, data
+
+            if shnum == 0 or shstrndx == 0xFFFF:
+                # too many sections for the ELF header: the real numbers
+                # are in section 0's sh_size and sh_link
+                first = header(0)
+                shnum = shnum or first[2]
+                if shstrndx == 0xFFFF:
+                    # sh_link comes straight after sh_offset and sh_size
+                    link_at = sh_at + struct.calcsize(order + sh_fmt)
+                    shstrndx, = struct.unpack_from(order + 'I', first[3], link_at)
+            headers = [header(i) for i in range(shnum)]
+            strtab_offset, strtab_size = headers[shstrndx][1:3]
+            f.seek(strtab_offset)
+            strtab = f.read(strtab_size)
+            if len(strtab) < strtab_size:
+                raise struct.error("truncated section name table")
+    except (IOError, struct.error, IndexError):
+        return None
+    return [strtab[name:strtab.find(b'\0', name)].decode('ascii', 'replace')
+            for name, offset, size, data in headers]
+
+def elf_has_debug_info(path):
+    """True if path is an ELF file with .debug_* sections for strip -S to remove."""
+    names = elf_section_names(path)
+    return bool(names) and any(name.startswith(('.debug', '.zdebug')) for name in names)
+
+def normalize_modes(top, dir_mode, file_modes):
+    """
+    In one walk of the tree under directory top, give every directory
+    (including top) permissions dir_mode, and every regular file whose
+    permissions are a key in dict file_modes the corresponding value, like
+    find -type d -exec chmod and find -type f -perm -exec chmod would.
+    Symlinks are left alone. Where the platform allows, directories are
+    walked and entries changed relative to an open directory descriptor
+    (fchmodat()). Returns the number of entries changed.
+    """
+    by_fd = os.scandir in os.supports_fd and os.chmod in os.supports_dir_fd
+    changed = 0
+    if stat.S_IMODE(os.stat(top).st_mode) != dir_mode:
+        os.chmod(top, dir_mode)
+        changed += 1
+    pending = [top]
+    while pending:
+        dirpath = pending.pop()
+        fd = os.open(dirpath, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)) if by_fd else None
+        try:
+            with os.scandir(dirpath if fd is None else fd) as it:
+                for entry in it:
+                    mode = entry.stat(follow_symlinks=False).st_mode
+                    if stat.S_ISDIR(mode):
+                        pending.append(os.path.join(dirpath, entry.name))
+                        new = dir_mode
+                    elif stat.S_ISREG(mode):
+                        new = file_modes.get(stat.S_IMODE(mode))
+                    else:
+                        continue
+                    if new is None or new == stat.S_IMODE(mode):
+                        continue
+                    if fd is None:
+                        os.chmod(entry.path, new)
+                    else:
+                        os.chmod(entry.name, new, dir_fd=fd)
+                    changed += 1
+        finally:
+            if fd is not None:
+                os.close(fd)
+    return changed
+
+def clone_tree(src, dst, mode='hardlink'):
+    """
+    Populate directory dst with everything in directory src: files are
+    hard-linked (mode 'hardlink') or reflinked (mode 'reflink') where the
+    filesystem allows, copied otherwise; symlinks are recreated. Anything
+    already in dst with the same name is replaced, anything else is left
+    alone. Returns the number of files cloned.
+    """
+    clone = dict(hardlink=os.link, reflink=reflink_file)[mode]
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(src):
+        reldir = os.path.relpath(dirpath, src)
+        dstdir = os.path.normpath(os.path.join(dst, reldir))
+        os.makedirs(dstdir, exist_ok=True)
+        # os.walk() lists symlinks to directories among dirnames (without
+        # following them)
+        for name in dirnames + filenames:
+            srcpath = os.path.join(dirpath, name)
+            dstpath = os.path.join(dstdir, name)
+            srcstat = os.lstat(srcpath)
+            try:
+                dststat = os.lstat(dstpath)
+            except OSError:
+                dststat = None
+            if os.path.isdir(srcpath) and not os.path.islink(srcpath):
+                if dststat is not None and not os.path.isdir(dstpath):
+                    os.remove(dstpath)
+                continue
+            if dststat is not None:
+                if (dststat.st_dev, dststat.st_ino) == (srcstat.st_dev, srcstat.st_ino):
+                    # already linked by a previous run
+                    continue
+                if os.path.isdir(dstpath) and not os.path.islink(dstpath):
+                    shutil.rmtree(dstpath)
+                else:
+                    os.remove(dstpath)
+            if os.path.islink(srcpath):
+                os.symlink(os.readlink(srcpath), dstpath)
+                continue
+            try:
+                clone(srcpath, dstpath)
+            except OSError as err:
+                if err.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                try:
+                    os.remove(dstpath)
+                except OSError:
+                    pass
+                shutil.copy2(srcpath, dstpath)
+            count += 1
+    return count
+
+def _zstandard_writer(fileobj):
+    try:
+        import zstandard
+    except ImportError:
+        raise ManifestError("zstd compression needs either the zstd program "
+                            "or the zstandard Python module")
+    # the same long-distance matching as zstd --long
+    params = zstandard.ZstdCompressionParameters.from_level(
+        3, enable_ldm=True, window_log=27, threads=-1)
+    return zstandard.ZstdCompressor(compression_params=params).stream_writer(fileobj)
+
+# Compressors for write_tarball(): codec name -> (filename extension, external
+# programs to try in order, each writing its stdin compressed to stdout,
+# fallback in-process compressor wrapping a binary file object). The external
+# programs can use every core; the fallbacks can't. Gzip output omits name and
+# timestamp so that it's reproducible.
+#
+# Roughly, for a viewer install tree:
+# gz    fast, but the biggest output.
+# bz2   what the Linux release tarball has always been. lbzip2 and pbzip2
+#       produce ordinary .bz2 files several times faster than bzip2 on a
+#       multi-core machine; with only bzip2 it's the slowest of the lot.
+# xz    the smallest output (typically 15-25% under bz2) and fast to
+#       decompress, but even with -T0 the slowest to compress.
+# zstd  much the fastest both ways; with --long (a 128MB window, which any
+#       zstd can decompress without extra options) it finds the repeats
+#       between the many similar libraries, landing between gz and xz.
+TARBALL_CODECS = {
+    'none': ('', [], None),
+    'gz':   ('.gz', [['pigz', '-n', '-c'], ['gzip', '-n', '-c']],
+             lambda f: __import__('gzip').GzipFile(filename='', mode='wb', fileobj=f, mtime=0)),
+    'bz2':  ('.bz2', [['lbzip2', '-c'], ['pbzip2', '-c'], ['bzip2', '-c']],
+             lambda f: __import__('bz2').BZ2File(f, 'wb')),
+    'xz':   ('.xz', [['xz', '-T0', '-c']],
+             lambda f: __import__('lzma').LZMAFile(f, 'wb')),
+    'zstd': ('.zst', [['zstd', '-T0', '--long', '-q', '-c']], _zstandard_writer),
+    }
+
+def tarball_extension(codec):
+    """The extension to append to '.tar' for a write_tarball() codec."""
+    try:
+        return TARBALL_CODECS[codec][0]
+    except KeyError:
+        raise ManifestError("Unknown tarball compression %r (expected one of %s)" %
+                            (codec, ', '.join(sorted(TARBALL_CODECS))))
+
+@contextlib.contextmanager
+def compressed_output(filename, codec):
+    """
+    Context manager yielding a writable binary stream; whatever is written
+    to it ends up in filename, compressed as specified by codec (see
+    TARBALL_CODECS).
+    """
+    extension, programs, fallback = TARBALL_CODECS[codec]
+    with open(filename, 'wb') as output:
+        for command in programs:
+            program = shutil.which(command[0])
+            if program:
+                compressor = subprocess.Popen([program] + command[1:],
+                                              stdin=subprocess.PIPE, stdout=output)
+                try:
+                    yield compressor.stdin
+                finally:
+                    compressor.stdin.close()
+                    returncode = compressor.wait()
+                if returncode:
+                    raise ManifestError("Command %s returned non-zero status (%s)"
+                                        % (command, returncode))
+                return
+        if fallback is None:
+            yield output
+            return
+        stream = fallback(output)
+        try:
+            yield stream
+        finally:
+            stream.close()
+
+def tree_members(top, prefix=''):
+    """
+    Generate write_tarball() (path, arcname) pairs for top and everything
+    below it, depth first with each directory's entries in sorted order,
+    so that the same tree always yields the same sequence. arcnames are
+    relative to top, under prefix if given (in which case top itself comes
+    first, as prefix).
+    """
+    def walk(dir, dirname):
+        for entry in sorted(os.scandir(dir), key=lambda entry: entry.name):
+            arcname = dirname + '/' + entry.name if dirname else entry.name
+            yield entry.path, arcname
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk(entry.path, arcname)
+
+    if prefix:
+        yield top, prefix
+    yield from walk(top, prefix)
+
+def normal_mode(mode):
+    """
+    Permission bits derived from the owner's alone: everyone may read and
+    execute what the owner may, only the owner may write. So 0700 and 0775
+    become 0755, 0600 and 0664 0644, 0400 0444. Keeps the builder's umask
+    out of the package.
+    """
+    owner = (mode >> 6) & 0o7
+    return (owner << 6) | ((owner & 0o5) << 3) | (owner & 0o5)
+
+def write_tarball(filename, members, codec='none', mtime=None, normal_modes=False):
+    """
+    Write (path, arcname) pairs to a tarball in one streaming pass, in the
+    order given, compressing with codec. Owner names and ids are blanked,
+    like tar --numeric-owner but without even revealing the builder's
+    uid. If mtime is given, every member gets that modification time, and
+    if normal_modes, the permissions normal_mode() derives; with both, the
+    same members with the same contents make a byte-identical tarball
+    (given the same compression program). Writes via a temporary file, so
+    filename never holds a partial archive.
+    """
+    temp = filename + '.tmp'
+    with compressed_output(temp, codec) as stream:
+        with tarfile.open(fileobj=stream, mode='w|', format=tarfile.GNU_FORMAT) as tf:
+            for path, arcname in members:
+                info = tf.gettarinfo(path, arcname)
+                if info is None:
+                    # sockets and such can't go in a tarball
+                    continue
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                if mtime is not None:
+                    info.mtime = mtime
+                if normal_modes and not info.issym():
+                    info.mode = normal_mode(info.mode)
+                if info.isreg():
+                    with open(path, 'rb') as f:
+                        tf.addfile(info, f)
+                else:
+                    tf.addfile(info)
+    os.replace(temp, filename)
+
 def proper_windows_path(path, current_platform = sys.platform):
     """ This function takes an absolute Windows or Cygwin path and
     returns a path appropriately formatted for the platform it's
@@ -103,6 +448,13 @@ BASE_ARGUMENTS=[
                      an installer for the current platform
           unpacked - bundles up the files in the destination directory into
                      a simple tarball
+          plan     - resolves every path and records the operations the copy
+                     action would perform, without touching the destination
+                     directory; other actions' finishing steps are skipped.
+                     Combine with --plan to see the result.
+          check    - just checks that every file the manifest names can be
+                     found, looking for them in parallel, and reports any
+                     that can't. Nothing is copied.
         Example use: %(name)s --actions="copy unpacked" """,
          default="copy package"),
     dict(name='arch',
@@ -124,10 +476,55 @@ BASE_ARGUMENTS=[
          description="""Addition to the channel for packaging and channel value,
          but not application name (used internally)""",
          default=None),
+    dict(name='copy_mode',
+         description="""How the copy action creates each destination file:
+          copy     - shutil.copy2()
+          reflink  - clone the file (FICLONE), on filesystems such as btrfs
+                     and XFS that support it
+          hardlink - hard-link files from the prebuilt packages directory,
+                     which don't change between builds
+          auto     - reflink if possible, else hard-link package files,
+                     else os.copy_file_range()
+        Packaging modifies files in place, so with the package action nothing
+        is hard-linked, and any links an earlier copy made are replaced.
+        Whatever can't be done that way falls back to shutil.copy2().
+        Example use: %(name)s --copy_mode=auto""",
+         default="copy"),
+    dict(name='copy_jobs',
+         description="""Number of files the copy action may copy concurrently.
+        Paths are still resolved, and file_list still recorded, in manifest
+        order; only the copies themselves overlap. The default of 1 copies
+        each file as it is processed.
+        Example use: %(name)s --copy_jobs=8""",
+         default="1"),
+    dict(name='clone_base',
+         description="""When building additional packages (see the
+        additional_packages environment variable), first fill each one's
+        destination from the base package's destination tree, by hardlink or
+        reflink. The copy action then sees those files as up to date, and
+        only rewrites what differs per channel (settings_install.xml,
+        build_data.json and the like): we always replace, never write into,
+        a destination file. Only meaningful if the finishing steps don't
+        modify the tree in ways that differ between packages.
+        Example use: %(name)s --clone_base=hardlink""",
+         default=None),
     dict(name='configuration',
          description="""The build configurations sub directory used.""",
          default="Release"),
+    dict(name='dedupe',
+         description="""What to do, when packaging, with files in the destination
+        tree whose contents are identical to another's: replace them with
+        relative "symlink"s or "hardlink"s to the first, leave them alone
+        ("none"), or do whatever this platform's manifest prefers ("auto").
+        Example use: %(name)s --dedupe=none""",
+         default="auto"),
     dict(name='dest', description='Destination directory.', default=DEFAULT_SRCTREE),
+    dict(name='fingerprint_hash',
+         description="""If ON, the copy action also records a content hash for
+        every file it copies, and only treats a file as unchanged if its hash
+        still matches. This catches edits that preserve both size and
+        modification time, at the cost of reading every source file.""",
+         default="OFF"),
     dict(name='grid',
          description="""Which grid the client will try to connect to.""",
          default=None),
@@ -138,6 +535,29 @@ BASE_ARGUMENTS=[
     dict(name='login_url',
          description="""The url that the login screen displays in the client.""",
          default=None),
+    dict(name='package_compression',
+         description="""Compression for the Linux release tarball: bz2 (the default, and
+        what's always been shipped), xz, zstd, gz or none. bz2 uses lbzip2
+        or pbzip2 where one is on the PATH, so it's parallel without
+        changing the file format; xz is smallest but slowest to make; zstd
+        is fastest to make and unpack at some cost in size.
+        Example use: %(name)s --package_compression=xz""",
+         default="bz2"),
+    dict(name='package_jobs',
+         description="""Number of additional packages (as listed in the
+        additional_packages environment variable) to build at the same time,
+        each in a process of its own whose output goes to <dest>.log. The
+        default of 1 builds them one after another, as before.
+        Example use: %(name)s --package_jobs=4""",
+         default="1"),
+    dict(name='plan',
+         description="""Build an explicit plan of the operations (mkdir, copy,
+        symlink, put_in_file, untar, command) that constructing the destination
+        tree involves, write it to this file as JSON, and then execute it (unless
+        the plan action was requested). construct() overrides that inspect
+        the destination tree as they go can't be planned ahead this way.
+        Example use: %(name)s --plan=manifest-plan.json""",
+         default=None),
     dict(name='platform',
          description="""The current platform, to be used for looking up which
         manifest class to run.""",
@@ -147,6 +567,23 @@ BASE_ARGUMENTS=[
         If no value is supplied, the default signature will be used, if any. Currently
         only used on Mac OS X.""",
          default=None),
+    dict(name='size_baseline',
+         description="""Size report JSON file (see size_report) to compare this build's
+        sizes with. Defaults to the report the previous build wrote.""",
+         default=None),
+    dict(name='size_budget',
+         description="""Comma-separated limits on the sizes in the size report; if any
+        is exceeded, packaging fails. Each is category=limit, where category
+        is total, dir:<top-level directory>, type:<file extension> or * (any
+        of those), and limit is an absolute size (e.g. 350M), or growth over
+        the baseline in bytes (+10M) or percent (+5%%).
+        Example use: %(name)s --size_budget=total=+40M,type:.pak=+10%%""",
+         default=None),
+    dict(name='size_report',
+         description="""JSON file in which to write the size report produced when
+        packaging: bytes per top-level directory and per file type, and the
+        largest files. Defaults to <dest>.size-report.json.""",
+         default=None),
     dict(name='source',
          description='Source directory.',
          default=DEFAULT_SRCTREE),
@@ -155,6 +592,27 @@ BASE_ARGUMENTS=[
         contain the name of the final package in a form suitable
         for use by a .bat file.""",
          default=None),
+    dict(name='trace',
+         description="""Write a Chrome trace-event JSON file recording how long each
+        prefix block, path() call, command and finishing step took. Load it
+        into chrome://tracing or https://ui.perfetto.dev.
+        Example use: %(name)s --trace=manifest-trace.json""",
+         default=None),
+    dict(name='unpacked_compression',
+         description="""Compression for the tarball made by the unpacked action:
+        none, gz, bz2, xz or zstd. Where pigz, lbzip2, pbzip2, xz or zstd
+        is on the PATH it compresses on all cores; otherwise Python's own
+        (single-threaded) modules are used.
+        Example use: %(name)s --unpacked_compression=zstd""",
+         default="none"),
+    dict(name='watch',
+         description="""After copying, keep running, and every so many seconds re-copy
+        any file from the source tree that has changed since (and pick up
+        new files and subdirectories in directories copied as a whole).
+        Handy for running the viewer from the destination directory while
+        editing shaders, XUI or settings. Stop it with Ctrl-C.
+        Example use: %(name)s --actions=copy --watch=0.5""",
+         default=None),
     dict(name='versionfile',
          description="""The name of a file containing the full version number."""),
     dict(name='package_dir',
@@ -282,25 +740,43 @@ def main(extra=[]):
             else:
                 base_touch_parts.insert(-2, "{}")
             base_touch_template = os.path.join(*base_touch_parts)
+        packages = []
         for package_id in additional_packages:
-            args['channel_suffix'] = os.environ.get(package_id + "_viewer_channel_suffix")
-            args['sourceid']       = os.environ.get(package_id + "_sourceid")
-            args['dest'] = base_dest_template.format(package_id)
-            if touch:
-                print('================ Creating additional package for "', package_id, '" in ', args['dest'])
-            else:
-                print('================ Starting additional copy for "', package_id, '" in ', args['dest'])
-            try:
-                wm = LLManifest.for_platform(args['platform'], args.get('arch'))(args)
-                wm.do(*args['actions'])
-            except Exception as err:
-                sys.exit(str(err))
-            if touch:
-                print('================ Created additional package ', wm.package_file, ' for ', package_id)
+            package_args = dict(args)
+            package_args['channel_suffix'] = os.environ.get(package_id + "_viewer_channel_suffix")
+            package_args['sourceid']       = os.environ.get(package_id + "_sourceid")
+            package_args['dest'] = base_dest_template.format(package_id)
+            packages.append((package_id, package_args))
+        clone_mode = args.get('clone_base')
+        if clone_mode:
+            if clone_mode not in ('hardlink', 'reflink'):
+                sys.exit("Unknown --clone_base %r (expected hardlink or reflink)" % clone_mode)
+            for package_id, package_args in packages:
+                count = clone_tree(args['dest'], package_args['dest'], clone_mode)
+                print('================ Cloned %s files of base package into %s' %
+                      (count, package_args['dest']))
+        package_jobs = int(args.get('package_jobs', 1))
+        if package_jobs > 1:
+            package_files = build_packages_in_parallel(packages, package_jobs, touch)
+        else:
+            package_files = {}
+            for package_id, package_args in packages:
+                if touch:
+                    print('================ Creating additional package for "', package_id, '" in ', package_args['dest'])
+                else:
+                    print('================ Starting additional copy for "', package_id, '" in ', package_args['dest'])
+                try:
+                    package_files[package_id] = build_package(package_args)
+                except Exception as err:
+                    sys.exit(str(err))
+                if touch:
+                    print('================ Created additional package ', package_files[package_id], ' for ', package_id)
+                else:
+                    print('================ Finished additional copy "', package_id, '" in ', package_args['dest'])
+        if touch:
+            for package_id, package_file in package_files.items():
                 with open(base_touch_template.format(package_id), 'w') as fp:
-                    fp.write('set package_file=%s\n' % wm.package_file)
-            else:
-                print('================ Finished additional copy "', package_id, '" in ', args['dest'])
+                    fp.write('set package_file=%s\n' % package_file)
     # Write out the package file in this format, so that it can easily be called
     # and used in a .bat file - yeah, it sucks, but this is the simplest...
     if touch:
@@ -309,6 +785,60 @@ def main(extra=[]):
         print('touched', touch)
     return 0
 
+def build_package(args, log=None):
+    """
+    Construct and run the manifest for one package as specified by args,
+    returning the resulting package_file (if any). If log is passed,
+    everything this process writes to stdout or stderr -- including the
+    output of commands it runs -- goes to that file instead: only use that
+    in a process of its own.
+    """
+    if log:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        logfd = os.open(log, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(logfd, sys.stdout.fileno())
+        os.dup2(logfd, sys.stderr.fileno())
+        os.close(logfd)
+    wm = LLManifest.for_platform(args['platform'], args.get('arch'))(args)
+    wm.do(*args['actions'])
+    return getattr(wm, 'package_file', None)
+
+def build_packages_in_parallel(packages, jobs, touch):
+    """
+    Build each (package_id, args) in packages using a pool of jobs
+    processes, each logging to its package's <dest>.log. Returns a dict of
+    package_id -> package_file once all are done; exits if any failed.
+    """
+    failures = []
+    package_files = {}
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = {}
+        for package_id, package_args in packages:
+            if package_args.get('trace'):
+                # each process collects its own trace
+                base, ext = os.path.splitext(package_args['trace'])
+                package_args['trace'] = '%s.%s%s' % (base, package_id, ext)
+            log = os.path.normpath(package_args['dest']) + '.log'
+            os.makedirs(os.path.dirname(log) or os.curdir, exist_ok=True)
+            print('================ Starting additional %s for "%s" in %s (log: %s)' %
+                  ('package' if touch else 'copy', package_id, package_args['dest'], log))
+            futures[pool.submit(build_package, package_args, log)] = (package_id, log)
+        for future in concurrent.futures.as_completed(futures):
+            package_id, log = futures[future]
+            try:
+                package_files[package_id] = future.result()
+            except Exception as err:
+                print('================ Failed additional package "%s": %s (see %s)' %
+                      (package_id, err, log))
+                failures.append("%s: %s" % (package_id, err))
+            else:
+                print('================ Finished additional package "%s": %s' %
+                      (package_id, package_files[package_id]))
+    if failures:
+        sys.exit('\n'.join(failures))
+    return package_files
+
 class LLManifestRegistry(type):
     def __init__(cls, name, bases, dct):
         super(LLManifestRegistry, cls).__init__(name, bases, dct)
@@ -318,8 +848,301 @@ class LLManifestRegistry(type):
 
 MissingFile = namedtuple("MissingFile", ("pattern", "tried"))
 
+class OrderedPathSet(object):
+    """
+    Enough of a list to stand in for one that's only ever appended to and
+    iterated, except that appending an item that's already there does
+    nothing: cmakedirs() notes the same directories over and over.
+    """
+    def __init__(self, items=()):
+        self.items = dict.fromkeys(items)
+
+    def append(self, item):
+        self.items[item] = None
+
+    def extend(self, items):
+        self.items.update(dict.fromkeys(items))
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, list(self.items))
+
+def lstat_kind(path):
+    """
+    'file', 'dir' or 'link' according to os.lstat(path), or None if there's
+    nothing there. See LLManifest.path_kind().
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError:
+        return None
+    if stat.S_ISLNK(mode):
+        return 'link'
+    return 'dir' if stat.S_ISDIR(mode) else 'file'
+
+# a path separator, either kind where there are two
+SEPARATORS = re.compile('[%s]' % re.escape(os.sep + (os.altsep or '')))
+
+def listing_path(path):
+    """
+    Like os.path.normpath(path), but leaving '..' components alone: the
+    kernel resolves 'build/../packages' relative to wherever build really
+    is, which isn't the directory containing build if build is a symlink.
+    scan_dir() listings are keyed on this.
+    """
+    if os.pardir not in path:
+        return os.path.normpath(path)
+    drive, rest = os.path.splitdrive(path)
+    root = os.sep if SEPARATORS.match(rest) else ''
+    parts = [part for part in SEPARATORS.split(rest) if part not in ('', os.curdir)]
+    return drive + root + os.sep.join(parts) or os.curdir
+
+def parse_size(text):
+    """'123', '64K', '10M' or '2G' (powers of 1024) as a number of bytes."""
+    match = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([KMG]?)B?\s*$', text, re.IGNORECASE)
+    if not match:
+        raise ManifestError("Can't make sense of size %r" % text)
+    scale = 1024 ** ' KMG'.index(match.group(2).upper() or ' ')
+    return int(float(match.group(1)) * scale)
+
+def format_size(size):
+    """Number of bytes as a short human-readable string."""
+    for unit in ('bytes', 'KB', 'MB'):
+        if abs(size) < 1024:
+            return ("%d %s" if unit == 'bytes' else "%.1f %s") % (size, unit)
+        size /= 1024.0
+    return "%.2f GB" % size
+
+def tar_member_path(name):
+    """
+    Tarball member name as a relative native path, refusing anything that
+    would land outside the directory we're extracting into.
+    """
+    path = os.path.normpath(name.replace('/', os.path.sep))
+    if os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.path.sep):
+        raise ManifestError("Refusing to extract tarball member %r" % name)
+    return path
+
+# Number of threads with which the check action looks for files
+CHECK_JOBS = 16
+
+# At most this many bytes of tarball member data are held in memory waiting
+# for a copy_pool thread to write them (see LLManifest.write_tar_member()).
+TAR_BUFFER_LIMIT = 64*1024*1024
+
+class WrittenEntry(object):
+    """
+    Stands in for the os.DirEntry of something LLManifest has just written,
+    so the scan_dir() listing of its directory needn't be read again. Only
+    its kind is known up front; stat() and inode() ask the filesystem.
+    """
+    def __init__(self, path, kind):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.kind = kind
+
+    def is_symlink(self):
+        return self.kind == 'link'
+
+    def is_dir(self, follow_symlinks=True):
+        if self.kind == 'link' and follow_symlinks:
+            return os.path.isdir(self.path)
+        return self.kind == 'dir'
+
+    def is_file(self, follow_symlinks=True):
+        if self.kind == 'link' and follow_symlinks:
+            return os.path.isfile(self.path)
+        return self.kind == 'file'
+
+    def stat(self, follow_symlinks=True):
+        return os.stat(self.path) if follow_symlinks else os.lstat(self.path)
+
+    def inode(self):
+        return os.lstat(self.path).st_ino
+
+# Arguments that change how we go about building a package, but not what's in
+# it, so they don't count towards LLManifest.input_fingerprint()
+PROCESS_ARGUMENTS = frozenset(('copy_jobs', 'copy_mode', 'fingerprint_hash',
+                               'plan', 'size_baseline', 'size_budget',
+                               'size_report', 'touch', 'trace', 'watch'))
+
+# Bump whenever the layout of the state file written by
+# LLManifest.save_state() changes: a mismatched file is simply ignored.
+STATE_VERSION = 3
+
+class ChromeTrace(object):
+    """
+    Collects timed events in the Chrome trace-event format. There's one
+    instance per output file, shared by every LLManifest in the process that
+    writes to it (see for_file()), so a run that builds several packages
+    produces one trace.
+    """
+    instances = {}
+
+    @classmethod
+    def for_file(cls, filename):
+        try:
+            return cls.instances[filename]
+        except KeyError:
+            trace = cls.instances[filename] = cls(filename)
+            return trace
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.events = []
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def now(self):
+        """microseconds since this trace started"""
+        return (time.perf_counter() - self.start) * 1000000
+
+    def complete(self, name, cat, start, dur, args):
+        with self.lock:
+            self.events.append(dict(name=name, cat=cat, ph='X', ts=start, dur=dur,
+                                    pid=os.getpid(), tid=threading.get_ident(),
+                                    args=args))
+
+    @contextlib.contextmanager
+    def span(self, name, cat, args):
+        """
+        Record the duration of the 'with' block as one event. The block may
+        add to the args dict it's given.
+        """
+        start = self.now()
+        try:
+            yield args
+        finally:
+            self.complete(name, cat, start, self.now() - start, args)
+
+    def write(self):
+        with self.lock:
+            events = list(self.events)
+        with open(self.filename, 'w') as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+
+class PlanOp(namedtuple("PlanOp", ("op", "src", "dst", "data"))):
+    """
+    One operation in a ManifestPlan. op is one of 'mkdir', 'copy',
+    'symlink' (copy symlink src, or with no src make a new symlink to
+    data, see LLManifest.make_symlink()), 'put_in_file', 'untar' (extract
+    one member of tarball src as dst) or 'command'; data holds the
+    contents for put_in_file, the member name for untar and the command
+    line for command.
+    """
+    def as_json(self):
+        result = dict(op=self.op)
+        if self.src is not None:
+            result['src'] = self.src
+        if self.dst is not None:
+            result['dst'] = self.dst
+        if self.op == 'put_in_file':
+            result['size'] = len(self.data)
+            result['sha1'] = hashlib.sha1(self.data).hexdigest()
+        elif self.op == 'untar':
+            result['member'] = self.data
+        elif self.op == 'symlink' and self.src is None:
+            result['target'] = self.data
+        elif self.op == 'command':
+            result['command'] = self.data
+        return result
+
+class ManifestPlan(object):
+    """
+    The operations LLManifest.construct() asked for, recorded instead of
+    performed (see the --plan argument), so they can be inspected, dumped,
+    optimised and then executed.
+    """
+    # ops that anything after them might depend on: don't move mkdirs or
+    # drop copies across them
+    barriers = ('symlink', 'command')
+
+    def __init__(self):
+        self.ops = []
+
+    def add(self, op, src=None, dst=None, data=None):
+        self.ops.append(PlanOp(op, src, dst, data))
+
+    def optimise(self):
+        """
+        Merge the mkdirs in each stretch between barriers into one set of
+        leaf directories at the start of the stretch, and drop any copy that
+        repeats the last write to the same destination.
+        """
+        result = []
+        segment = []
+        for op in self.ops + [None]:
+            if op is not None and op.op not in self.barriers:
+                segment.append(op)
+                continue
+            dirs = [o.dst for o in segment if o.op == 'mkdir']
+            # os.makedirs() creates ancestors anyway
+            ancestors = set(a for d in dirs for a in path_ancestors(d)[1:])
+            leaves = sorted(set(d for d in dirs if d not in ancestors))
+            result.extend(PlanOp('mkdir', None, d, None) for d in leaves)
+            result.extend(o for o in segment if o.op != 'mkdir')
+            if op is not None:
+                result.append(op)
+            segment = []
+        self.ops = []
+        last_write = {}
+        for op in result:
+            if op.op in self.barriers:
+                # a command may have changed anything since
+                last_write = {}
+            if op.op in ('copy', 'put_in_file', 'symlink', 'untar'):
+                if op.op == 'copy' and last_write.get(op.dst) == op:
+                    continue
+                last_write[op.dst] = op
+            self.ops.append(op)
+
+    def summary(self):
+        counts = defaultdict(int)
+        for op in self.ops:
+            counts[op.op] += 1
+        return ', '.join('%s %s' % (counts[op], op) for op in sorted(counts))
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(dict(version=1, ops=[op.as_json() for op in self.ops]), f, indent=1)
+
+    def execute(self, manifest):
+        """Perform each op on behalf of manifest, copies via its copy pool."""
+        # a run of 'untar' ops for the same tarball takes one pass over it
+        runs = itertools.groupby(self.ops, lambda op: (op.op, op.src) if op.op == 'untar' else id(op))
+        for key, ops in runs:
+            op = next(ops)
+            if op.op == 'untar':
+                dsts = {op.data: op.dst}
+                dsts.update((o.data, o.dst) for o in ops)
+                manifest.extract_tar(op.src, dsts)
+            elif op.op == 'mkdir':
+                manifest.cmakedirs(op.dst)
+            elif op.op == 'symlink' and op.src is None:
+                manifest.wait_for_copies()
+                manifest.make_symlink(op.data, op.dst)
+            elif op.op in ('copy', 'symlink'):
+                manifest.schedule_copy(op.src, op.dst)
+            elif op.op == 'put_in_file':
+                manifest.write_file(op.data, op.dst)
+            elif op.op == 'command':
+                manifest.run_command(op.data)
+        manifest.wait_for_copies()
+
 class LLManifest(object, metaclass=LLManifestRegistry):
     manifests = {}
+    # what --dedupe=auto means for this platform, see dedupe_files()
+    dedupe_policy = 'none'
+    # files smaller than this aren't worth deduplicating
+    dedupe_min_size = 4096
     def for_platform(self, platform, arch = None):
         if arch:
             platform = platform + '_' + arch + '_'
@@ -336,9 +1159,55 @@ class LLManifest(object, metaclass=LLManifestRegistry):
         self.artwork_prefix = [args['artwork']]
         self.build_prefix = [args['build']]
         self.dst_prefix = [args['dest']]
-        self.created_paths = []
+        self.created_paths = OrderedPathSet()
         self.package_name = "Unknown"
         self.missing = []
+        # set by finish() when package_tree_ready() should report sizes
+        self.size_report_due = False
+        self.copy_jobs = max(1, int(args.get('copy_jobs', 1)))
+        self.copy_pool = None
+        # dst -> (src, Future) for copies handed to copy_pool
+        self.pending_copies = {}
+        # bytes of tarball data handed to copy_pool, see write_tar_member()
+        self.tar_buffered = 0
+        self.copy_mode = args.get('copy_mode', 'copy')
+        if self.copy_mode not in ('copy', 'reflink', 'hardlink', 'auto'):
+            raise ManifestError("Unknown --copy_mode %r" % self.copy_mode)
+        # names of copy backends that have proven unsupported in this run
+        self.unsupported_backends = set()
+        self.fingerprint_hash = args.get('fingerprint_hash', 'OFF').upper() == 'ON'
+        # directory -> {name: os.DirEntry}, see scan_dir()
+        self.dir_entries = {}
+        # directory -> its st_mtime_ns when scan_dir() read it (or when we
+        # last wrote to it, see note_write())
+        self.dir_mtimes = {}
+        # compiled regexes, see wildcard_regex() and glob_regex()
+        self.wildcard_regexes = {}
+        self.glob_regexes = {}
+        # (len(excludes), regex, subtree regex), see exclusion_matcher()
+        self.exclusions = None
+        # path -> includes() result for the current exclusions
+        self.included = {}
+        # persistent state, see load_state()
+        self.state = None
+        self.state_dirty = False
+        self.state_lock = threading.Lock()
+        # while planning (see do()), the ManifestPlan being recorded
+        self.plan = None
+        self.trace = ChromeTrace.for_file(args['trace']) if args.get('trace') else None
+        # (start, description) for each prefix() block, while tracing
+        self.prefix_spans = []
+        # dst -> sha1 of the contents put_in_file() wrote there
+        self.generated = {}
+        # [src, dst] for each copy_action(): called directly, it copies
+        # things (whole trees, even) that never appear in file_list
+        self.copied_pairs = []
+        # for the check action: a pool of threads looking for files, and a
+        # (pattern, try_prefixes, optional, Future) for each path() call
+        self.check_pool = None
+        self.checks = []
+        # source directory -> destination, for each process_directory()
+        self.directory_map = {}
 
     def default_channel(self):
         return self.args.get('channel', None) == RELEASE_CHANNEL
@@ -352,6 +1221,7 @@ class LLManifest(object, metaclass=LLManifestRegistry):
         """ Excludes all files that match the glob from being included
         in the file list by path()."""
         self.excludes.append(glob)
+        self.exclusions = None
 
     def prefix(self, src='', build='', dst='', src_dst=None):
         """
@@ -398,6 +1268,8 @@ class LLManifest(object, metaclass=LLManifestRegistry):
         self.artwork_prefix.append(src)
         self.build_prefix.append(build)
         self.dst_prefix.append(dst)
+        if self.trace is not None:
+            self.prefix_spans.append((self.trace.now(), dict(src=src, build=build, dst=dst)))
 
 ##      self.display_stacks()
 
@@ -458,6 +1330,7 @@ class LLManifest(object, metaclass=LLManifestRegistry):
                 # find the attribute in 'self.manifest' named by 'stack', and
                 # truncate that list back to 'prevlen'
                 del getattr(self.manifest, stack)[prevlen:]
+            self.manifest.end_prefix_spans(self.prevlen['src_prefix'] - 1)
 
 ##          self.manifest.display_stacks()
 
@@ -472,9 +1345,36 @@ class LLManifest(object, metaclass=LLManifestRegistry):
         artwork = self.artwork_prefix.pop()
         build = self.build_prefix.pop()
         dst = self.dst_prefix.pop()
+        self.end_prefix_spans(len(self.src_prefix) - 1)
         if descr and not(src == descr or build == descr or dst == descr):
             raise ValueError("End prefix '" + descr + "' didn't match '" +src+ "' or '" +dst + "'")
 
+    def end_prefix_spans(self, depth):
+        """While tracing, close the spans of prefix blocks nested deeper than depth."""
+        while len(self.prefix_spans) > depth:
+            start, args = self.prefix_spans.pop()
+            self.trace.complete('prefix', 'prefix', start, self.trace.now() - start, args)
+
+    def tracing(self, name, cat='manifest', **args):
+        """
+        Context manager timing the 'with' block for --trace; yields a dict of
+        event args the block can add to. Costs next to nothing when not
+        tracing.
+        """
+        if self.trace is None:
+            return contextlib.nullcontext(args)
+        return self.trace.span(name, cat, args)
+
+    def source_bytes(self, pairs):
+        """Total size of the source files in a list of file_list pairs."""
+        total = 0
+        for src, dst in pairs:
+            try:
+                total += os.lstat(src).st_size
+            except (OSError, TypeError):
+                pass
+        return total
+
     def get_src_prefix(self):
         """ Returns the current source prefix."""
         return os.path.join(*self.src_prefix)
@@ -504,6 +1404,9 @@ class LLManifest(object, metaclass=LLManifestRegistry):
     def dst_path_of(self, relpath):
         """Returns the full path to a file or directory specified
         relative to the destination directory."""
+        # Whoever asks for a destination path is usually about to look at
+        # what's there, so make sure outstanding copies have landed.
+        self.wait_for_copies()
         return os.path.join(self.get_dst_prefix(), relpath)
 
     def _relative_dst_path(self, dstpath):
@@ -540,28 +1443,42 @@ class LLManifest(object, metaclass=LLManifestRegistry):
         Runs an external command.  
         Raises ManifestError exception if the command returns a nonzero status.
         """
+        if self.plan is not None:
+            self.plan.add('command', data=command)
+            return
+        # the command may well operate on files we're still copying
+        self.wait_for_copies()
         print("Running command:", command)
         sys.stdout.flush()
-        try:
-            subprocess.check_call(command)
-        except subprocess.CalledProcessError as err:
-            raise ManifestError( "Command %s returned non-zero status (%s)"
-                                % (command, err.returncode) )
+        with self.tracing('run_command', 'command', command=command) as trace_args:
+            try:
+                subprocess.check_call(command)
+                trace_args['returncode'] = 0
+            except subprocess.CalledProcessError as err:
+                trace_args['returncode'] = err.returncode
+                raise ManifestError( "Command %s returned non-zero status (%s)"
+                                    % (command, err.returncode) )
+            finally:
+                # the command could have changed anything on disk
+                self.forget_listings()
 
     def created_path(self, path):
         """ Declare that you've created a path in order to
           a) verify that you really have created it
           b) schedule it for cleanup"""
-        if not os.path.exists(path):
+        if self.path_kind(path) is None:
             raise ManifestError("Should be something at path " + path)
         self.created_paths.append(path)
 
     def put_in_file(self, contents, dst, src=None):
-        # write contents as dst
+        # write contents as dst (dst_path_of() also waits for pending copies,
+        # one of which might be to this same file)
         dst_path = self.dst_path_of(dst)
-        self.cmakedirs(os.path.dirname(dst_path))
-        with open(dst_path, 'wb') as f:
-            f.write(contents)
+        self.generated[dst_path] = hashlib.sha1(contents).hexdigest()
+        if self.plan is not None:
+            self.plan.add('put_in_file', src, dst_path, contents)
+        else:
+            self.write_file(contents, dst_path)
 
         # Why would we create a file in the destination tree if not to include
         # it in the installer? The default src=None (plus the fact that the
@@ -570,30 +1487,116 @@ class LLManifest(object, metaclass=LLManifestRegistry):
             self.file_list.append([src, dst_path])
         return dst_path
 
+    def write_file(self, contents, dst_path):
+        """Write bytes contents as the file dst_path, replacing it."""
+        self.cmakedirs(os.path.dirname(dst_path))
+        # If dst is a hard link (--copy_mode), don't write through it.
+        try:
+            os.unlink(dst_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+        with open(dst_path, 'wb') as f:
+            f.write(contents)
+        self.note_write(dst_path, 'file')
+
     def replace_in(self, src, dst=None, searchdict={}):
+        """
+        Write src, with each key of searchdict replaced by its value, as dst.
+        A value can also be an iterable of strings (e.g. a generator), which
+        is spliced into the output in a single pass once the string values
+        have been replaced, rather than being built up into one string and
+        then copied again by every later replacement.
+        """
         if dst == None:
             dst = src
         # read src
         with open(self.src_path_of(src), "r") as f:
             contents = f.read()
         # apply dict replacements
+        pieces = {}
         for old, new in searchdict.items():
-            contents = contents.replace(old, new)
+            if isinstance(new, str):
+                contents = contents.replace(old, new)
+            else:
+                pieces[old] = new
+        if pieces:
+            output = []
+            start = 0
+            for match in re.finditer('|'.join(map(re.escape, pieces)), contents):
+                output.append(contents[start:match.start()])
+                new = pieces[match.group()]
+                if not isinstance(new, str):
+                    # an iterator can only be consumed once
+                    new = pieces[match.group()] = ''.join(new)
+                output.append(new)
+                start = match.end()
+            output.append(contents[start:])
+            contents = ''.join(output)
         self.put_in_file(contents.encode(), dst)
         self.created_paths.append(dst)
 
     def copy_action(self, src, dst):
-        if src and (os.path.exists(src) or os.path.islink(src)):
+        if src and self.path_kind(src) is not None:
             # ensure that destination path exists
             self.cmakedirs(os.path.dirname(dst))
             self.created_paths.append(dst)
-            self.ccopymumble(src, dst)
+            self.copied_pairs.append([src, dst])
+            self.schedule_copy(src, dst)
         else:
             print("Doesn't exist:", src)
 
+    def schedule_copy(self, src, dst):
+        """
+        Copy src to dst using ccopymumble(). With --copy_jobs=1 that happens
+        right now; otherwise the copy is handed to a pool of worker threads
+        and may still be in flight when we return. The caller must already
+        have created the directory containing dst.
+
+        wait_for_copies() blocks until every scheduled copy has finished.
+        While planning, the copy is just recorded.
+        """
+        if self.plan is not None:
+            self.plan.add('symlink' if self.path_kind(src) == 'link' else 'copy', src, dst)
+            return
+        if self.copy_jobs <= 1 or self.path_kind(src) == 'dir':
+            # A whole-tree copy could overlap anything else in flight, so
+            # let everything else land first and then do it inline.
+            self.wait_for_copies()
+            self.ccopymumble(src, dst)
+            return
+        if self.copy_pool is None:
+            self.copy_pool = concurrent.futures.ThreadPoolExecutor(self.copy_jobs)
+        # If this dst is already being written, a second copy must not race
+        # the first: wait for it before starting ours.
+        previous = self.pending_copies.pop(dst, None)
+        if previous is not None:
+            previous[1].result()
+        self.pending_copies[dst] = (src, self.copy_pool.submit(self.ccopymumble, src, dst))
+
+    def wait_for_copies(self):
+        """
+        Block until every copy scheduled by schedule_copy() has finished.
+        Raises ManifestError listing any that failed.
+        """
+        pending, self.pending_copies = self.pending_copies, {}
+        errors = []
+        for dst, (src, future) in pending.items():
+            try:
+                future.result()
+            except (IOError, os.error) as why:
+                errors.append("%s => %s: %s" % (src, dst, why))
+        if errors:
+            raise ManifestError("Failed to copy:\n  " + "\n  ".join(errors))
+
     def package_action(self, src, dst):
         pass
 
+    def plan_action(self, src, dst):
+        # record what the copy action would do, if it isn't doing that itself
+        if 'copy' not in self.actions:
+            self.copy_action(src, dst)
+
     def finish(self):
         """
         generic finish, always called before the ${action}_finish() methods
@@ -628,6 +1631,255 @@ class LLManifest(object, metaclass=LLManifestRegistry):
             print('*' * 72)
             raise MissingError('%s patterns could not be found' % len(self.missing))
 
+        # Nothing below applies if we haven't really copied anything.
+        if 'plan' in self.actions or 'check' in self.actions:
+            return
+
+        # Only tidy up duplicates in a tree we're about to package.
+        if 'copy' in self.actions and \
+           ('package' in self.actions or 'unpacked' in self.actions):
+            policy = self.args.get('dedupe', 'auto')
+            if policy == 'auto':
+                policy = self.dedupe_policy
+            if policy not in ('none', 'symlink', 'hardlink'):
+                raise ManifestError("Unknown --dedupe %r" % policy)
+            if policy != 'none':
+                with self.tracing('dedupe_files', policy=policy) as trace_args:
+                    trace_args.update(saved=self.dedupe_files(policy))
+
+        # Do this after deduplicating, since that changes what we'd ship. But
+        # package_finish() may change the tree some more (stripping binaries,
+        # say), so then it's up to package_tree_ready().
+        if 'package' in self.actions or self.args.get('size_report') or \
+           self.args.get('size_budget'):
+            self.size_report_due = True
+            if 'package' not in self.actions:
+                self.package_tree_ready()
+
+    def package_tree_ready(self, changed=True):
+        """
+        package_finish() overrides call this once they're done changing the
+        destination tree and before archiving it, so that the size report
+        (and --size_budget) describe what actually ships, and an oversized
+        package fails before time is spent compressing it. do() calls it
+        after package_finish() in case that didn't. changed=False says the
+        package is up to date (see artifact_is_current()), so the last report
+        still stands.
+        """
+        if not self.size_report_due:
+            return
+        self.size_report_due = False
+        if not changed:
+            print("Package unchanged: sizes as in %s" % self.size_report_path())
+            return
+        with self.tracing('size_report'):
+            self.report_sizes()
+
+    def size_report_path(self):
+        return self.args.get('size_report') or \
+               os.path.normpath(self.dst_prefix[0]) + '.size-report.json'
+
+    def size_report(self, largest=20):
+        """
+        Tally what file_list puts in the destination tree: total bytes, bytes
+        per top-level directory and per file type, and the largest files.
+        Sizes are of what's actually there (a deduplicated symlink costs next
+        to nothing), or of the source if the destination hasn't been written.
+        """
+        root = os.path.normpath(self.dst_prefix[0])
+        sizes = {}
+        for src, dst in self.file_list:
+            dst = os.path.normpath(dst)
+            if not dst.startswith(root + os.path.sep) or dst in sizes:
+                continue
+            for path in dst, src:
+                try:
+                    st = os.lstat(path)
+                except (OSError, TypeError):
+                    continue
+                if not stat.S_ISDIR(st.st_mode):
+                    sizes[dst] = st.st_size
+                break
+        dirs = defaultdict(int)
+        types = defaultdict(int)
+        for dst, size in sizes.items():
+            relpath = dst[len(root)+1:]
+            parts = relpath.split(os.path.sep)
+            dirs[parts[0] if len(parts) > 1 else os.curdir] += size
+            # lump versioned shared libraries (libfoo.so.1.2) in with .so
+            name = re.sub(r'\.so(\.\d+)+$', '.so', parts[-1])
+            types[os.path.splitext(name)[1].lower() or '(none)'] += size
+        biggest = sorted(sizes.items(), key=operator.itemgetter(1), reverse=True)[:largest]
+        return dict(version=1,
+                    total=sum(sizes.values()),
+                    files=len(sizes),
+                    dirs=dict(dirs),
+                    types=dict(types),
+                    largest=[[dst[len(root)+1:].replace(os.path.sep, '/'), size]
+                             for dst, size in biggest])
+
+    def report_sizes(self):
+        """
+        Print size_report(), with changes since the baseline report, write it
+        to size_report_path() and enforce --size_budget.
+        """
+        report = self.size_report()
+        path = self.size_report_path()
+        baseline = None
+        try:
+            with open(self.args.get('size_baseline') or path) as f:
+                baseline = json.load(f)
+            if baseline.get('version') != report['version']:
+                baseline = None
+        except (IOError, ValueError, AttributeError):
+            pass
+
+        categories = [('total', report['total'], baseline and baseline.get('total'))]
+        for kind, key in ('dir', 'dirs'), ('type', 'types'):
+            old = baseline.get(key, {}) if baseline else {}
+            for name in sorted(set(report[key]) | set(old)):
+                categories.append(('%s:%s' % (kind, name), report[key].get(name, 0),
+                                   old.get(name, 0) if baseline else None))
+
+        print("Package size: %s in %s files" % (format_size(report['total']), report['files']))
+        for name, size, before in categories:
+            line = "  %-30s %12s" % (name, format_size(size))
+            if before is not None and before != size:
+                line += "  (%+d bytes)" % (size - before)
+            print(line)
+        print("Largest files:")
+        for relpath, size in report['largest']:
+            print("  %12s  %s" % (format_size(size), relpath))
+
+        over = self.check_size_budget(categories)
+        if over:
+            # don't let an oversized build become the next baseline
+            raise ManifestError("Package size budget exceeded:\n  " + "\n  ".join(over))
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        os.replace(temp, path)
+
+    def check_size_budget(self, categories):
+        """
+        Compare (name, size, baseline size or None) categories with the
+        --size_budget limits; return a description of each one exceeded.
+        """
+        budget = self.args.get('size_budget')
+        if not budget:
+            return []
+        limits = []
+        for item in budget.split(','):
+            name, sep, limit = item.strip().partition('=')
+            if not sep:
+                raise ManifestError("--size_budget item %r isn't category=limit" % item)
+            limits.append((name.strip(), limit.strip()))
+        over = []
+        unchecked = []
+        for name, size, before in categories:
+            for pattern, limit in limits:
+                if pattern != '*' and pattern != name:
+                    continue
+                if not limit.startswith('+'):
+                    allowed = parse_size(limit)
+                elif before is None:
+                    if name not in unchecked:
+                        unchecked.append(name)
+                    continue
+                elif limit.endswith('%'):
+                    allowed = before + before * float(limit[1:-1]) / 100
+                else:
+                    allowed = before + parse_size(limit[1:])
+                if size > allowed:
+                    over.append("%s is %s, over its budget of %s (%s)" %
+                                (name, format_size(size), format_size(allowed), limit))
+        if unchecked:
+            print("No baseline to check size growth of: %s" % ', '.join(unchecked))
+        return over
+
+    def dedupe_files(self, policy):
+        """
+        Find files in file_list's destinations with identical contents (and
+        permissions): group them by size first, then by hash. In each group,
+        replace all but the first (in path order) with a relative symlink to
+        it, or a hard link, according to policy. Returns the bytes saved.
+        """
+        root = os.path.normpath(self.dst_prefix[0])
+        by_size = defaultdict(list)
+        for dst in sorted(set(os.path.normpath(dst) for src, dst in self.file_list)):
+            if not dst.startswith(root + os.path.sep):
+                continue
+            try:
+                st = os.lstat(dst)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size >= self.dedupe_min_size:
+                by_size[(st.st_size, st.st_mode, st.st_dev)].append((dst, st.st_ino))
+
+        saved = 0
+        for (size, mode, dev), files in by_size.items():
+            if len(files) < 2:
+                continue
+            by_hash = defaultdict(list)
+            for dst, ino in files:
+                sha256 = hashlib.sha256()
+                with open(dst, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024*1024), b''):
+                        sha256.update(chunk)
+                by_hash[sha256.digest()].append((dst, ino))
+            for same in by_hash.values():
+                (first, first_ino), rest = same[0], same[1:]
+                for dst, ino in rest:
+                    if policy == 'hardlink' and ino == first_ino:
+                        # already one file
+                        continue
+                    temp = dst + '.dedupe'
+                    if policy == 'symlink':
+                        os.symlink(os.path.relpath(first, os.path.dirname(dst)), temp)
+                    else:
+                        os.link(first, temp)
+                    os.replace(temp, dst)
+                    self.note_write(dst, 'link' if policy == 'symlink' else 'file')
+                    self.record_dedupe(dst, first)
+                    print("Deduplicated %s => %s (%s bytes)" %
+                          (self._relative_dst_path(dst), self._relative_dst_path(first), size))
+                    saved += size
+        print("Deduplication saved %s bytes" % saved)
+        return saved
+
+    def record_dedupe(self, dst, first):
+        """
+        Note in the state file that dst, copied earlier, is now a link to
+        first, so that ccopyfile() can leave it that way while neither source
+        changes (see dedupe_is_current()). Without a record of either copy,
+        forget dst's: what's there now isn't the copy the state file describes.
+        """
+        files = self.load_state()['files']
+        key = self.fingerprint_key(dst)
+        first_key = self.fingerprint_key(first)
+        recorded = files.get(key)
+        if recorded is None or files.get(first_key) is None:
+            if files.pop(key, None) is not None:
+                self.state_dirty = True
+            return
+        st = os.lstat(dst)
+        files[key] = recorded[:5] + [st.st_ino, st.st_size, st.st_mtime_ns,
+                                     first_key, files[first_key][:5]]
+        self.state_dirty = True
+
+    def dedupe_is_current(self, dedupe):
+        """
+        dedupe is what record_dedupe() stored after a destination's fingerprint
+        (empty if it was never deduplicated): is the file it links to still
+        there, and still copied from an unchanged source?
+        """
+        if not dedupe:
+            return True
+        first_key, first_fingerprint = dedupe
+        first = os.path.join(self.dst_prefix[0], *first_key.split('/'))
+        return self.path_kind(first) == 'file' and \
+               self.source_fingerprint(first_fingerprint[0]) == first_fingerprint
+
     def copy_finish(self):
         pass
 
@@ -635,15 +1887,107 @@ class LLManifest(object, metaclass=LLManifestRegistry):
         pass
 
     def unpacked_finish(self):
-        unpacked_file_name = "unpacked_%(plat)s_%(vers)s.tar" % {
+        codec = self.args.get('unpacked_compression', 'none')
+        unpacked_file_name = "unpacked_%(plat)s_%(vers)s.tar%(ext)s" % {
             'plat':self.args['platform'],
-            'vers':'_'.join(self.args['version'])}
+            'vers':'_'.join(self.args['version']),
+            'ext':tarball_extension(codec)}
+        unpacked_path = self.src_path_of(unpacked_file_name)
+        if self.artifact_is_current(unpacked_path):
+            print("Unpacked file is up to date:", unpacked_file_name)
+            return
         print("Creating unpacked file:", unpacked_file_name)
-        # could add a gz here but that doubles the time it takes to do this step
-        tf = tarfile.open(self.src_path_of(unpacked_file_name), 'w:')
-        # add the entire installation package, at the very top level
-        tf.add(self.get_dst_prefix(), "")
-        tf.close()
+        self.forget_artifact(unpacked_path)
+        # add the entire installation package, at the very top level: not
+        # just file_list, but also whatever copy_action(), symlinkf() and
+        # run_command() put there; dated, and with permissions, as in the
+        # Linux package, so the same inputs make the same tarball
+        write_tarball(unpacked_path, tree_members(self.get_dst_prefix()), codec,
+                      mtime=self.newest_input_mtime(), normal_modes=True)
+        self.record_artifact(unpacked_path)
+
+    def input_entries(self):
+        """
+        What goes into the package, sorted: for each file_list or
+        copy_action() entry [source, destination relative to the destination
+        root, [size, mtime_ns] of the source] (or, for put_in_file() output,
+        a hash of the contents in place of the size and mtime). A source
+        directory counts as everything in it.
+        """
+        root = self.dst_prefix[0]
+        entries = []
+        pairs = set((src, dst) for src, dst in itertools.chain(self.file_list, self.copied_pairs))
+        for src, dst in pairs:
+            if src and lstat_kind(src) == 'dir':
+                # a whole tree: the directory's own size and mtime don't
+                # change when a file in it is edited
+                for path, arcname in tree_members(src, os.path.relpath(dst, root)):
+                    st = os.lstat(path)
+                    entries.append([path, arcname, [st.st_size, st.st_mtime_ns]])
+                continue
+            try:
+                st = os.lstat(src)
+                source = [st.st_size, st.st_mtime_ns]
+            except (OSError, TypeError):
+                source = self.generated.get(dst)
+            entries.append([src, os.path.relpath(dst, root), source])
+        entries.sort(key=lambda entry: entry[:2])
+        return entries
+
+    def input_fingerprint(self):
+        """
+        A digest of everything that goes into the package (see
+        input_entries()), plus our arguments and which manifest class this
+        is. Computed once construct() is done.
+        """
+        entries = self.input_entries()
+        args = dict((key, value) for key, value in self.args.items()
+                    if key not in PROCESS_ARGUMENTS)
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps([type(self).__module__ + '.' + type(self).__name__,
+                                args, entries],
+                               sort_keys=True, default=str).encode())
+        return sha1.hexdigest()
+
+    def newest_input_mtime(self):
+        """
+        The modification time, in whole seconds, of the newest source that
+        goes into the package (see input_entries()), or None if there are
+        none: a timestamp for package contents that means something, but
+        only changes when the inputs do.
+        """
+        mtimes = [source[1] for src, dst, source in self.input_entries()
+                  if isinstance(source, list)]
+        return max(mtimes) // 10**9 if mtimes else None
+
+    def artifact_is_current(self, artifact):
+        """
+        True if artifact exists and record_artifact() says it was built from
+        inputs identical to this run's, so the step producing it can be
+        skipped.
+        """
+        try:
+            with open(artifact + '.fingerprint') as f:
+                recorded = f.read().strip()
+        except IOError:
+            return False
+        return os.path.exists(artifact) and recorded == self.input_fingerprint()
+
+    def record_artifact(self, artifact):
+        """Remember the inputs from which artifact was just built."""
+        with open(artifact + '.fingerprint', 'w') as f:
+            f.write(self.input_fingerprint() + '\n')
+
+    def forget_artifact(self, artifact):
+        """
+        Call before rebuilding artifact: if that fails, a stale fingerprint
+        mustn't vouch for whatever is left behind.
+        """
+        try:
+            os.remove(artifact + '.fingerprint')
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
 
     def cleanup_finish(self):
         """ Delete paths that were specified to have been created by this script"""
@@ -654,7 +1998,7 @@ class LLManifest(object, metaclass=LLManifestRegistry):
     def process_either(self, src, dst):
         # If it's a real directory, recurse through it --
         # but not a symlink! Handle those like files.
-        if os.path.isdir(src) and not os.path.islink(src):
+        if self.path_kind(src) == 'dir':
             return self.process_directory(src, dst)
         else:
             return self.process_file(src, dst)
@@ -674,11 +2018,13 @@ class LLManifest(object, metaclass=LLManifestRegistry):
             return 0
 
     def process_directory(self, src, dst):
-        if not self.includes(src, dst):
+        if not self.includes(src, dst) or self.excludes_subtree(src):
             sys.stdout.write(" (excluding %r, %r)" % (src, dst))
             sys.stdout.flush()
             return 0
-        names = os.listdir(src)
+        self.directory_map[src] = dst
+        # scan_dir() also tells process_either()/ccopymumble() what each is
+        names = list(self.scan_dir(src))
         self.cmakedirs(dst)
         errors = []
         count = 0
@@ -689,48 +2035,139 @@ class LLManifest(object, metaclass=LLManifestRegistry):
         return count
 
     def includes(self, src, dst):
-        if src:
-            for excl in self.excludes:
-                if fnmatch.fnmatch(src, excl):
-                    return False
-        return True
+        if not src:
+            return True
+        regex = self.exclusion_matcher()[1]
+        try:
+            return self.included[src]
+        except KeyError:
+            pass
+        # same semantics as fnmatch.fnmatch(src, excl) for each excl
+        result = self.included[src] = \
+            regex is None or regex.match(os.path.normcase(src)) is None
+        return result
+
+    def excludes_subtree(self, src):
+        """
+        True if every path below directory src is certainly excluded, so
+        there's no point in even listing it. That's the case when some
+        exclusion pattern ends with '*' and the rest of it already matches
+        (a prefix of) src + separator.
+        """
+        regex = self.exclusion_matcher()[2]
+        return regex is not None and \
+               regex.match(os.path.normcase(os.path.join(src, ''))) is not None
+
+    def exclusion_matcher(self):
+        """
+        Compile self.excludes into a single regex (and a second one for
+        excludes_subtree()), rebuilt only when exclusions are added.
+        """
+        if self.exclusions is None or self.exclusions[0] != len(self.excludes):
+            # fnmatch.fnmatch() normcases both name and pattern
+            patterns = [os.path.normcase(excl) for excl in self.excludes]
+            regex = subtree = None
+            if patterns:
+                regex = re.compile('|'.join(fnmatch.translate(p) for p in patterns))
+            # fnmatch.translate() anchors its result with a trailing \Z:
+            # strip that, so the pattern need only match a prefix.
+            prefixes = [fnmatch.translate(p[:-1])[:-2] for p in patterns if p.endswith('*')]
+            if prefixes:
+                subtree = re.compile('|'.join(prefixes))
+            self.exclusions = (len(self.excludes), regex, subtree)
+            self.included = {}
+        return self.exclusions
 
     def remove(self, *paths):
+        self.wait_for_copies()
         for path in paths:
-            if os.path.exists(path):
+            kind = self.path_kind(path)
+            if kind is not None:
                 print("Removing path", path)
-                if os.path.isdir(path):
+                if kind == 'dir':
+                    self.forget_below(path)
                     shutil.rmtree(path)
                 else:
                     os.remove(path)
+                self.note_write(path, None)
 
     def ccopymumble(self, src, dst):
         """Copy a single symlink, file or directory."""
-        if os.path.islink(src):
+        kind = self.path_kind(src)
+        if kind == 'link':
             linkto = os.readlink(src)
-            if os.path.islink(dst) or os.path.isfile(dst):
+            dstkind = self.path_kind(dst)
+            if dstkind in ('link', 'file'):
                 os.remove(dst)  # because symlinking over an existing link fails
-            elif os.path.isdir(dst):
+            elif dstkind == 'dir':
+                self.forget_below(dst)
                 shutil.rmtree(dst)
             os.symlink(linkto, dst)
-        elif os.path.isdir(src):
+            self.note_write(dst, 'link')
+        elif kind == 'dir':
             self.ccopytree(src, dst)
         else:
             self.ccopyfile(src, dst)
             # XXX What about devices, sockets etc.?
             # YYY would we put such things into a viewer package?!
 
-    def ccopyfile(self, src, dst):
-        """ Copy a single file.  Uses filecmp to skip copying for existing files."""
-        # Don't recopy file if it's up-to-date.
-        # If we seem to be not not overwriting files that have been
-        # updated, set the last arg to False, but it will take longer.
-##      reldst = (dst[len(self.dst_prefix[0]):]
-##                if dst.startswith(self.dst_prefix[0])
-##                else dst).lstrip(r'\/')
-        if os.path.exists(dst) and filecmp.cmp(src, dst, True):
-##          print "{} (skipping, {} exists)".format(src, reldst)
+    def make_symlink(self, linkto, dst):
+        """
+        Make dst a symlink to linkto, replacing whatever is at dst unless
+        it's already that symlink. While planning, the link is just recorded.
+        """
+        if self.plan is not None:
+            self.plan.add('symlink', dst=dst, data=linkto)
             return
+        kind = self.path_kind(dst)
+        if kind == 'link':
+            if os.readlink(dst) == linkto:
+                # the requested link already exists
+                return
+            os.remove(dst)
+        elif kind == 'dir':
+            print("Requested symlink (%s) exists but is a directory; replacing" % dst)
+            self.forget_below(dst)
+            shutil.rmtree(dst)
+        elif kind == 'file':
+            print("Requested symlink (%s) exists but is a file; replacing" % dst)
+            os.remove(dst)
+        os.symlink(linkto, dst)
+        self.note_write(dst, 'link')
+
+    def ccopyfile(self, src, dst):
+        """ Copy a single file.  Skips copying files that the state file says
+        are unchanged since we last copied them."""
+        # Don't recopy file if it's up-to-date. For a destination within our
+        # tree, that's decided by comparing the source's fingerprint and the
+        # destination's inode, size and mtime with what we recorded the last
+        # time we copied it, so that a destination changed in place (stripped,
+        # signed, edited) gets copied again. (A destination dedupe_files()
+        # replaced with a link is compared as that link.) All come from
+        # scan_dir(), so a no-op run costs one scandir() per directory plus a
+        # stat() per destination file rather than several stats per file.
+        key = self.fingerprint_key(dst)
+        fingerprint = self.source_fingerprint(src) if key else None
+        if 'package' in self.actions and self.is_hard_link(src, dst):
+            # An earlier copy without packaging (--copy_mode=auto or
+            # hardlink) linked dst to a package file. Packaging is about to
+            # change dst in place, so it must be a copy of its own.
+            pass
+        elif fingerprint is None:
+            # not ours to track: fall back to the shallow filecmp check
+            if self.path_kind(dst) == 'file' and filecmp.cmp(src, dst, True):
+                return
+        else:
+            recorded = self.load_state()['files'].get(key)
+            if recorded is None:
+                # Nothing recorded (e.g. first run with a state file): trust
+                # the old filecmp check this once, and remember the answer.
+                if self.path_kind(dst) == 'file' and filecmp.cmp(src, dst, True):
+                    self.record_fingerprint(key, fingerprint, dst)
+                    return
+            elif recorded[:5] == fingerprint and recorded[5:8] == self.dst_signature(dst) \
+                 and self.dedupe_is_current(recorded[8:]):
+                return
         # only copy if it's not excluded
         if self.includes(src, dst):
             try:
@@ -739,17 +2176,281 @@ class LLManifest(object, metaclass=LLManifestRegistry):
                 if err.errno != errno.ENOENT:
                     raise
 
-##          print "{} => {}".format(src, reldst)
-            shutil.copy2(src, dst)
+            self.clone_file(src, dst)
+            self.note_write(dst, 'file')
+            if fingerprint is not None:
+                self.record_fingerprint(key, fingerprint, dst)
+
+    def clone_file(self, src, dst):
+        """
+        Create dst (which must not exist) as a copy of src, using the cheapest
+        backend --copy_mode allows, falling back to shutil.copy2().
+        """
+        for backend in self.copy_backends(src):
+            if backend.__name__ in self.unsupported_backends:
+                continue
+            try:
+                backend(src, dst)
+                return
+            except OSError as err:
+                if err.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                # Don't keep trying something this filesystem can't do.
+                # (We may be mistaken for a few files on some other
+                # filesystem, but they'll still get copied.)
+                self.unsupported_backends.add(backend.__name__)
+                try:
+                    os.unlink(dst)
+                except OSError:
+                    pass
+        shutil.copy2(src, dst)
+
+    def copy_backends(self, src):
+        """List the functions clone_file() should try, in order, for src."""
+        if self.copy_mode == 'copy':
+            return []
+        if self.copy_mode == 'reflink':
+            return [reflink_file]
+        # A hard link shares the inode, so anything packaging does to the
+        # destination file (strip, chmod, sign) would happen to the package
+        # file too.
+        link = [os.link] if self.is_immutable_input(src) and 'package' not in self.actions else []
+        if self.copy_mode == 'hardlink':
+            return link
+        return [reflink_file] + link + [range_copy_file]
+
+    def packages_dir(self):
+        """The directory into which prebuilt packages are installed."""
+        return self.args.get('package_dir') or \
+               os.path.join(self.args['build'], os.pardir, 'packages')
+
+    def is_immutable_input(self, src):
+        """Is src a file from the prebuilt packages directory?"""
+        pkgdir = os.path.abspath(self.packages_dir())
+        return os.path.abspath(src).startswith(pkgdir + os.path.sep)
+
+    def scan_dir(self, path):
+        """
+        Return a dict mapping each name in directory 'path' to its
+        os.DirEntry. Each directory is only scanned once per run (see
+        rescan_if_changed()); a directory that doesn't exist produces an
+        empty dict.
+        """
+        path = listing_path(path)
+        entries = self.dir_entries.get(path)
+        if entries is None:
+            try:
+                self.dir_mtimes[path] = os.stat(path).st_mtime_ns
+                with os.scandir(path) as it:
+                    entries = {entry.name: entry for entry in it}
+            except OSError:
+                self.dir_mtimes[path] = None
+                entries = {}
+            self.dir_entries[path] = entries
+        return entries
+
+    def rescan_if_changed(self, path):
+        """
+        Something other than LLManifest (a construct() override writing a
+        file, say) might have added to directory 'path' since scan_dir() read
+        it. That would change the directory's mtime: if so, forget the old
+        listing. Returns True if it did.
+        """
+        path = listing_path(path)
+        if path not in self.dir_entries:
+            return False
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.dir_mtimes.get(path):
+            return False
+        # (pop: a check_pool thread may be doing the same)
+        self.dir_entries.pop(path, None)
+        return True
+
+    def path_kind(self, path):
+        """
+        'file', 'dir' or 'link' according to what's at path (without
+        following symlinks), or None if there's nothing. This is what the
+        os.path.exists()/isdir()/islink() probes in the copy machinery
+        boil down to, answered from scan_dir()'s DirEntry objects (which
+        know file types without a stat() on most platforms) so the same path
+        isn't examined over and over.
+        """
+        path = listing_path(path)
+        head, tail = os.path.split(path)
+        if not tail or tail in (os.curdir, os.pardir):
+            return lstat_kind(path)
+        head = head or os.curdir
+        entry = self.scan_dir(head).get(tail)
+        if entry is None and self.rescan_if_changed(head):
+            entry = self.scan_dir(head).get(tail)
+        if entry is None:
+            # The listing is case-sensitive; the filesystem may not be.
+            return lstat_kind(path) if CASE_INSENSITIVE_FS else None
+        if entry.is_symlink():
+            return 'link'
+        return 'dir' if entry.is_dir(follow_symlinks=False) else 'file'
+
+    def note_write(self, path, kind):
+        """
+        Keep scan_dir() listings true to a change we just made ourselves:
+        path is now of kind 'file', 'dir' or 'link', or gone (None). The
+        directory's recorded mtime moves on too, so that our own writes
+        don't make rescan_if_changed() read it all over again.
+
+        Returns False if the listing of path's directory already had it as
+        kind (so it existed before), True otherwise.
+        """
+        path = listing_path(path)
+        head, tail = os.path.split(path)
+        if not tail:
+            return False
+        head = head or os.curdir
+        entries = self.dir_entries.get(head)
+        if entries is None:
+            return True
+        old = entries.get(tail)
+        if old is not None and kind == 'dir' and old.is_dir(follow_symlinks=False) \
+           and not old.is_symlink():
+            return False
+        if kind is None:
+            entries.pop(tail, None)
+        else:
+            entries[tail] = WrittenEntry(path, kind)
+        try:
+            self.dir_mtimes[head] = os.stat(head).st_mtime_ns
+        except OSError:
+            pass
+        return True
+
+    def forget_below(self, path):
+        """
+        Forget scan_dir() listings of directory path and everything under
+        it, which we're about to remove.
+        """
+        path = listing_path(path)
+        below = path + os.path.sep
+        # (list() because other threads may be scanning as we go)
+        for dir in list(self.dir_entries):
+            if dir == path or dir.startswith(below):
+                self.dir_entries.pop(dir, None)
+
+    def forget_listings(self):
+        """
+        Forget everything scan_dir() has read: after run_command(), say,
+        anything could have changed anywhere.
+        """
+        self.dir_entries.clear()
+        self.dir_mtimes.clear()
+
+    def fingerprint_key(self, dst):
+        """
+        Key under which the state file records dst: its path relative to the
+        destination root, or None if dst lies outside that tree.
+        """
+        root = os.path.normpath(self.dst_prefix[0])
+        dst = os.path.normpath(dst)
+        if not dst.startswith(root + os.path.sep):
+            return None
+        return dst[len(root)+1:].replace(os.path.sep, '/')
+
+    def source_fingerprint(self, src):
+        """
+        [src, size, mtime_ns, inode, hash] for the source file src, or None if
+        scan_dir() can't see it. hash is None unless --fingerprint_hash=ON.
+        """
+        srcdir, name = os.path.split(src)
+        entry = self.scan_dir(srcdir).get(name)
+        if entry is None:
+            return None
+        st = entry.stat()
+        digest = None
+        if self.fingerprint_hash:
+            sha1 = hashlib.sha1()
+            with open(src, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024*1024), b''):
+                    sha1.update(chunk)
+            digest = sha1.hexdigest()
+        return [src, st.st_size, st.st_mtime_ns, st.st_ino, digest]
+
+    def is_hard_link(self, src, dst):
+        """Are src and dst the same file (as scan_dir() last saw them)?"""
+        signature = self.dst_signature(dst)
+        if signature is None:
+            return False
+        srcdir, name = os.path.split(src)
+        entry = self.scan_dir(srcdir).get(name)
+        if entry is None or entry.inode() != signature[0]:
+            return False
+        # same inode number: make sure it's the same filesystem too
+        return os.path.samefile(src, dst)
+
+    def dst_signature(self, dst):
+        """
+        [inode, size, mtime_ns] of dst as of this run's scan of its
+        directory, or None.
+        """
+        dstdir, name = os.path.split(dst)
+        entry = self.scan_dir(dstdir).get(name)
+        if entry is None:
+            return None
+        st = entry.stat(follow_symlinks=False)
+        return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    def record_fingerprint(self, key, fingerprint, dst):
+        st = os.lstat(dst)
+        self.load_state()['files'][key] = fingerprint + [st.st_ino, st.st_size, st.st_mtime_ns]
+        self.state_dirty = True
+
+    def state_path(self):
+        """
+        Pathname of the file in which we keep state about the destination
+        tree from one run to the next. It lives next to the destination
+        directory rather than inside it, so it never gets packaged.
+        """
+        return os.path.normpath(self.dst_prefix[0]) + '.manifest-state.json'
+
+    def load_state(self):
+        """
+        Return the persistent state dict, reading it from state_path() the
+        first time. A missing, unreadable or out-of-date file just means we
+        start from scratch.
+        """
+        with self.state_lock:
+            if self.state is None:
+                try:
+                    with open(self.state_path()) as f:
+                        state = json.load(f)
+                    if state.get('version') != STATE_VERSION:
+                        raise ValueError("stale state file")
+                except (IOError, ValueError, AttributeError):
+                    state = dict(version=STATE_VERSION)
+                state.setdefault('files', {})
+                self.state = state
+            return self.state
+
+    def save_state(self):
+        """Write the persistent state back to state_path(), if it changed."""
+        if not self.state_dirty:
+            return
+        path = self.state_path()
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(temp, path)
+        self.state_dirty = False
 
     def ccopytree(self, src, dst):
         """Direct copy of shutil.copytree with the additional
         feature that the destination directory can exist.  It
         is so dumb that Python doesn't come with this. Also it
         implements the excludes functionality."""
-        if not self.includes(src, dst):
+        if not self.includes(src, dst) or self.excludes_subtree(src):
             return
-        names = os.listdir(src)
+        # scan_dir() also tells process_either()/ccopymumble() what each is
+        names = list(self.scan_dir(src))
         self.cmakedirs(dst)
         errors = []
         for name in names:
@@ -769,8 +2470,15 @@ class LLManifest(object, metaclass=LLManifestRegistry):
 #        print "making path: ", path
         path = os.path.normpath(path)
         self.created_paths.append(path)
-        if not os.path.exists(path):
-            os.makedirs(path)
+        if self.plan is not None:
+            self.plan.add('mkdir', dst=path)
+        elif self.path_kind(path) is None:
+            # exist_ok: a ccopytree() on a copy_pool thread may be creating
+            # the same directory
+            os.makedirs(path, exist_ok=True)
+            # makedirs() may have created any number of ancestors too
+            while path and self.note_write(path, 'dir'):
+                path = os.path.dirname(path)
 
     def find_existing_file(self, *list):
         for f in list:
@@ -785,18 +2493,133 @@ class LLManifest(object, metaclass=LLManifestRegistry):
     def contents_of_tar(self, src_tar, dst_dir):
         """ Extracts the contents of the tarfile (specified
         relative to the source prefix) into the directory
-        specified relative to the destination directory."""
-        self.check_file_exists(src_tar)
-        tf = tarfile.open(self.src_path_of(src_tar), 'r')
-        for member in tf.getmembers():
-            tf.extract(member, self.ensure_dst_dir(dst_dir))
-            # TODO get actions working on these dudes, perhaps we should extract to a temporary directory and then process_directory on it?
-            self.file_list.append([src_tar,
-                           self.dst_path_of(os.path.join(dst_dir,member.name))])
-        tf.close()
+        specified relative to the destination directory.
+
+        The tarball (which may be compressed) is read front to back just
+        once, a member at a time. Each member is matched against exclude()
+        patterns as if the tarball were a directory, and the included ones
+        go into file_list and through the actions: for each action we call
+        <action>_tar_action(tf, member, dst, done) if there is one (the copy
+        action's extracts the member), else <action>_action(tarball, dst).
+        Returns the number of members processed."""
+        tarpath = self.src_path_of(src_tar)
+        self.check_file_exists(tarpath)
+        dst_root = os.path.join(self.get_dst_prefix(), dst_dir)
+        count = 0
+        # member name -> dst, for hard links to earlier members
+        done = {}
+        with self.tracing('contents_of_tar', tarball=tarpath) as trace_args, \
+             tarfile.open(tarpath, 'r|*') as tf:
+            for member in tf:
+                dst = os.path.join(dst_root, tar_member_path(member.name))
+                if not self.includes(os.path.join(tarpath, tar_member_path(member.name)), dst):
+                    continue
+                for action in self.actions:
+                    method = getattr(self, action + "_tar_action", None)
+                    if method is not None:
+                        method(tf, member, dst, done)
+                    else:
+                        method = getattr(self, action + "_action", None)
+                        if method is not None:
+                            method(tarpath, dst)
+                done[member.name] = dst
+                self.file_list.append([tarpath, dst])
+                count += 1
+            trace_args.update(count=count)
+        return count
+
+    def copy_tar_action(self, tf, member, dst, done):
+        if self.plan is not None:
+            self.plan.add('untar', tf.name, dst, member.name)
+        else:
+            self.write_tar_member(tf, member, dst, done)
+
+    def plan_tar_action(self, tf, member, dst, done):
+        # record what the copy action would do, if it isn't doing that itself
+        if 'copy' not in self.actions:
+            self.copy_tar_action(tf, member, dst, done)
+
+    def extract_tar(self, tarpath, dsts):
+        """
+        Stream tarball tarpath, writing each member named in dict dsts to
+        the destination path it maps to. See ManifestPlan.execute().
+        """
+        done = {}
+        with tarfile.open(tarpath, 'r|*') as tf:
+            for member in tf:
+                dst = dsts.get(member.name)
+                if dst is not None:
+                    self.write_tar_member(tf, member, dst, done)
+                    done[member.name] = dst
+
+    def write_tar_member(self, tf, member, dst, done):
+        """
+        Write tarball member, which must be the one tf's stream has just
+        reached, as dst. done maps the names of members already written to
+        their destinations, for hard links. With --copy_jobs > 1 a file's
+        data is read here but written by the copy_pool, so that writing
+        overlaps decompressing the rest of the tarball.
+        """
+        if member.isdir():
+            self.cmakedirs(dst)
+            return
+        self.cmakedirs(os.path.dirname(dst))
+        # don't write through whatever (link) might be there already
+        previous = self.pending_copies.pop(dst, None)
+        if previous is not None:
+            previous[1].result()
+        kind = self.path_kind(dst)
+        if kind == 'dir':
+            self.forget_below(dst)
+            shutil.rmtree(dst)
+        elif kind is not None:
+            os.remove(dst)
+        if member.issym():
+            os.symlink(member.linkname, dst)
+            self.note_write(dst, 'link')
+        elif member.islnk():
+            target = done.get(member.linkname)
+            if target is None:
+                raise ManifestError("%s: hard link %s to unknown member %s" %
+                                    (tf.name, member.name, member.linkname))
+            self.wait_for_copies()
+            shutil.copy2(target, dst)
+            self.note_write(dst, 'file')
+        elif member.isfile():
+            data = tf.extractfile(member)
+            if self.copy_jobs <= 1 or member.size > TAR_BUFFER_LIMIT:
+                with open(dst, 'wb') as f:
+                    shutil.copyfileobj(data, f)
+                self.finish_tar_member(member, dst)
+                return
+            if self.copy_pool is None:
+                self.copy_pool = concurrent.futures.ThreadPoolExecutor(self.copy_jobs)
+            # don't let more than TAR_BUFFER_LIMIT bytes pile up in memory
+            self.tar_buffered += member.size
+            if self.tar_buffered > TAR_BUFFER_LIMIT:
+                self.wait_for_copies()
+                self.tar_buffered = member.size
+            self.pending_copies[dst] = (
+                tf.name, self.copy_pool.submit(self.write_tar_data, data.read(), member, dst))
+        else:
+            print("Skipping %s in %s: not a file, directory or link" % (member.name, tf.name))
+
+    def write_tar_data(self, contents, member, dst):
+        with open(dst, 'wb') as f:
+            f.write(contents)
+        self.finish_tar_member(member, dst)
+
+    def finish_tar_member(self, member, dst):
+        os.chmod(dst, member.mode & 0o7777)
+        os.utime(dst, (member.mtime, member.mtime))
+        self.note_write(dst, 'file')
 
 
     def wildcard_regex(self, src_glob, dst_glob):
+        try:
+            return self.wildcard_regexes[(src_glob, dst_glob)]
+        except KeyError:
+            pass
         src_re = re.escape(src_glob)
         src_re = src_re.replace('\*', '([-a-zA-Z0-9._ ]*)')
         dst_temp = dst_glob
@@ -804,21 +2627,76 @@ class LLManifest(object, metaclass=LLManifestRegistry):
         while dst_temp.count("*") > 0:
             dst_temp = dst_temp.replace('*', '\g<' + str(i) + '>', 1)
             i = i+1
-        return re.compile(src_re), dst_temp
+        result = self.wildcard_regexes[(src_glob, dst_glob)] = (re.compile(src_re), dst_temp)
+        return result
+
+    def glob_regex(self, pattern):
+        """Compiled regex equivalent to fnmatch pattern, built once per run."""
+        regex = self.glob_regexes.get(pattern)
+        if regex is None:
+            # fnmatch ignores case wherever os.path.normcase() folds it
+            flags = re.IGNORECASE if os.path.normcase('A') == 'a' else 0
+            regex = self.glob_regexes[pattern] = re.compile(fnmatch.translate(pattern), flags)
+        return regex
+
+    def lexists(self, path):
+        """
+        Like os.path.lexists(), but answered from scan_dir() listings, so
+        probing many names in one directory costs one scandir().
+        """
+        head, tail = os.path.split(path)
+        if not tail:
+            # 'path' ends with a separator (or is a root): must be a directory
+            if head == path:
+                return os.path.isdir(path)
+            return self.lexists(head) and os.path.isdir(path)
+        return self.path_kind(path) is not None
+
+    def glob(self, pattern):
+        """
+        Like glob.glob() (same matches, same order), but answered from
+        scan_dir() listings.
+        """
+        dirname, basename = os.path.split(pattern)
+        if not GLOB_MAGIC.search(pattern):
+            return [pattern] if self.lexists(pattern) else []
+        if GLOB_MAGIC.search(dirname):
+            dirs = self.glob(dirname)
+        else:
+            dirs = [dirname]
+        result = []
+        for dir in dirs:
+            if not GLOB_MAGIC.search(basename):
+                # e.g. 'skins/*/textures.xml': just probe each candidate
+                candidate = os.path.join(dir, basename)
+                if self.lexists(candidate):
+                    result.append(candidate)
+                continue
+            regex = self.glob_regex(basename)
+            listdir = dir or os.curdir
+            self.rescan_if_changed(listdir)
+            # (list() because a copy_pool thread may add to the listing)
+            for name in list(self.scan_dir(listdir)):
+                # like glob, '*' doesn't match hidden files
+                if name.startswith('.') and not basename.startswith('.'):
+                    continue
+                if regex.match(name):
+                    result.append(os.path.join(dir, name))
+        return result
 
     def check_file_exists(self, path):
-        if not os.path.exists(path) and not os.path.islink(path):
+        if not self.lexists(path):
             raise MissingError("Path %s doesn't exist" % (os.path.abspath(path),))
 
 
     wildcard_pattern = re.compile(r'\*')
     def expand_globs(self, src, dst):
-        src_list = glob.glob(src)
+        src_list = self.glob(src)
         src_re, d_template = self.wildcard_regex(src.replace('\\', '/'),
                                                  dst.replace('\\', '/'))
         for s in src_list:
             d = src_re.sub(d_template, s.replace('\\', '/'))
-            yield os.path.normpath(s), os.path.normpath(d)
+            yield listing_path(s), os.path.normpath(d)
 
     def path2basename(self, path, file):
         """
@@ -838,104 +2716,414 @@ class LLManifest(object, metaclass=LLManifestRegistry):
         return self.path(os.path.join(path, file), file)
 
     def path(self, src, dst=None):
-        sys.stdout.flush()
-        if src == None:
-            raise ManifestError("No source file, dst is " + dst)
-        if dst == None:
-            dst = src
-        dst = os.path.join(self.get_dst_prefix(), dst)
-        sys.stdout.write("Processing %s => %s ... " % (src, self._relative_dst_path(dst)))
+        return self.resolve_path(src, dst, optional=False)
 
-        def try_path(src):
-            # expand globs
-            count = 0
-            if self.wildcard_pattern.search(src):
-                for s,d in self.expand_globs(src, dst):
-                    assert(s != d)
-                    count += self.process_file(s, d)
-            else:
-                # if we're specifying a single path (not a glob),
-                # we should error out if it doesn't exist
-                self.check_file_exists(src)
-                count += self.process_either(src, dst)
-            return count
-
-        try_prefixes = [self.get_src_prefix(), self.get_artwork_prefix(), self.get_build_prefix()]
-        for pfx in try_prefixes:
-            try:
-                count = try_path(os.path.join(pfx, src))
-            except MissingError:
-                # if we produce MissingError, just try the next prefix
-                continue
-            # If we actually found nonzero files, stop looking
-            if count:
-                break
-        else:
-            # no more prefixes left to try
-            print(("\nunable to find '%s'; looked in:\n  %s" % (src, '\n  '.join(try_prefixes))))
-            self.missing.append(MissingFile(pattern=src, tried=try_prefixes))
-            # At this point 'count' might never have been successfully
-            # assigned! Even if it was, though, we can be sure it is 0.
-            return 0
+    def path_optional(self, src, dst=None):
+        return self.resolve_path(src, dst, optional=True)
 
-        print("%d files" % count)
+    def path_many(self, names, dst=None):
+        """
+        Process each of names as if by self.path(name, os.path.join(dst, name))
+        (or self.path(name) if dst is None), producing the same file_list
+        entries in the same order and noting the same MissingFiles. Instead
+        of a separately logged and traced search per name, though, the whole
+        batch is one search, looking names up with the same lexists() probes
+        resolve_path() makes, and any names found nowhere are reported
+        together.
 
-        # Let caller check whether we processed as many files as expected. In
-        # particular, let caller notice 0.
-        return count
+        Names containing wildcards are simply passed to self.path().
 
-    def path_optional(self, src, dst=None):
+        Returns the total number of files processed.
+        """
+        if self.check_pool is not None:
+            return sum(self.path(name, name if dst is None else os.path.join(dst, name))
+                       for name in names)
+        sys.stdout.flush()
+        names = list(names)
+        reldst = self._relative_dst_path(os.path.join(self.get_dst_prefix(), dst or ''))
+        sys.stdout.write("Processing %d names => %s ... " % (len(names), reldst))
+
+        with self.tracing('path_many', names=len(names), dst=reldst) as trace_args:
+            oldlen = len(self.file_list)
+            try_prefixes = [self.get_src_prefix(), self.get_artwork_prefix(), self.get_build_prefix()]
+            total = 0
+            missing = []
+            for name in names:
+                dstname = name if dst is None else os.path.join(dst, name)
+                if self.wildcard_pattern.search(name):
+                    total += self.path(name, dstname)
+                    continue
+                dstname = os.path.join(self.get_dst_prefix(), dstname)
+                for pfx in try_prefixes:
+                    src = os.path.join(pfx, name)
+                    # lexists() answers from one scandir() per prefix directory
+                    if self.lexists(src):
+                        count = self.process_either(src, dstname)
+                        # If we actually found nonzero files, stop looking
+                        if count:
+                            total += count
+                            break
+                else:
+                    missing.append(name)
+
+            print("%d files" % total)
+            if missing:
+                print(("unable to find %d of %d names; looked in:\n  %s\nfor:\n  %s" %
+                       (len(missing), len(names), '\n  '.join(try_prefixes),
+                        '\n  '.join(missing))))
+                self.missing.extend(MissingFile(pattern=name, tried=try_prefixes)
+                                    for name in missing)
+                trace_args.update(missing=missing)
+            if self.trace is not None:
+                trace_args.update(count=total,
+                                  bytes=self.source_bytes(self.file_list[oldlen:]))
+
+        return total
+
+    def resolve_path(self, src, dst, optional):
+        """
+        Implementation of path() and path_optional(): process src, found in
+        the first of the source, artwork and build prefixes that has it, as
+        dst. If it can't be found at all, path() notes a MissingFile while
+        path_optional() just says so.
+        """
         sys.stdout.flush()
         if src == None:
             raise ManifestError("No source file, dst is " + dst)
         if dst == None:
             dst = src
         dst = os.path.join(self.get_dst_prefix(), dst)
+        if self.check_pool is not None:
+            return self.check_path(src, optional)
         sys.stdout.write("Processing %s => %s ... " % (src, self._relative_dst_path(dst)))
 
-        def try_path(src):
-            # expand globs
-            count = 0
-            if self.wildcard_pattern.search(src):
-                for s,d in self.expand_globs(src, dst):
-                    assert(s != d)
-                    count += self.process_file(s, d)
+        with self.tracing('path', pattern=src, dst=self._relative_dst_path(dst)) as trace_args:
+            oldlen = len(self.file_list)
+            try_prefixes = [self.get_src_prefix(), self.get_artwork_prefix(), self.get_build_prefix()]
+            is_glob = self.wildcard_pattern.search(src)
+            for pfx in try_prefixes:
+                # Skip a prefix that hasn't got src before try_path() raises
+                # MissingError about it: lexists() answers from scan_dir()
+                # listings. (A glob that matches nothing just counts 0.)
+                if not is_glob and not self.lexists(os.path.join(pfx, src)):
+                    continue
+                count = self.try_path(os.path.join(pfx, src), dst)
+                # If we actually found nonzero files, stop looking
+                if count:
+                    break
             else:
-                # if we're specifying a single path (not a glob),
-                # we should error out if it doesn't exist
-                self.check_file_exists(src)
-                count += self.process_either(src, dst)
-            return count
+                if optional:
+                    sys.stdout.write("Skipping %s\n" % (src))
+                    return 0
+                # no more prefixes left to try
+                print(("\nunable to find '%s'; looked in:\n  %s" % (src, '\n  '.join(try_prefixes))))
+                self.missing.append(MissingFile(pattern=src, tried=try_prefixes))
+                trace_args.update(missing=True)
+                # At this point 'count' might never have been successfully
+                # assigned! Even if it was, though, we can be sure it is 0.
+                return 0
+
+            print("%d files" % count)
+            if self.trace is not None:
+                trace_args.update(prefix=pfx, count=count,
+                                  bytes=self.source_bytes(self.file_list[oldlen:]))
+
+        # Let caller check whether we processed as many files as expected. In
+        # particular, let caller notice 0.
+        return count
 
+    def check_path(self, src, optional):
+        """
+        For the check action: have a check_pool thread look for src in the
+        try-prefixes, to be reported by collect_checks() if it's nowhere.
+        Since we don't wait to find out, report 1 file found.
+        """
         try_prefixes = [self.get_src_prefix(), self.get_artwork_prefix(), self.get_build_prefix()]
+        self.checks.append((src, try_prefixes, optional,
+                            self.check_pool.submit(self.find_prefix, src, try_prefixes)))
+        return 1
+
+    def find_prefix(self, src, try_prefixes):
+        """
+        The first of try_prefixes in which pattern src matches anything, or
+        None. Unlike path(), this doesn't look inside directories: a
+        directory whose contents are all excluded still counts as found.
+        """
+        found = self.glob if self.wildcard_pattern.search(src) else self.lexists
         for pfx in try_prefixes:
-            try:
-                count = try_path(os.path.join(pfx, src))
-            except MissingError:
-                # if we produce MissingError, just try the next prefix
-                continue
-            # If we actually found nonzero files, stop looking
-            if count:
-                break
-        else:
-            sys.stdout.write("Skipping %s\n" % (src))
-            return 0
+            if found(os.path.join(pfx, src)):
+                return pfx
+        return None
 
-        print("%d files" % count)
+    def collect_checks(self):
+        """
+        Wait for the check_path() lookups and note a MissingFile for each
+        required pattern that wasn't found, for finish() to report.
+        """
+        found = 0
+        for src, try_prefixes, optional, future in self.checks:
+            if future.result() is not None:
+                found += 1
+            elif not optional:
+                self.missing.append(MissingFile(pattern=src, tried=try_prefixes))
+        print("Checked %d patterns: %d found, %d missing" %
+              (len(self.checks), found, len(self.missing)))
+        self.checks = []
+
+    def try_path(self, src, dst):
+        """
+        Process src, relative to one particular prefix, as dst. Raises
+        MissingError if src isn't a glob and doesn't exist.
+        """
+        # expand globs
+        count = 0
+        if self.wildcard_pattern.search(src):
+            for s,d in self.expand_globs(src, dst):
+                assert(s != d)
+                count += self.process_file(s, d)
+        else:
+            # if we're specifying a single path (not a glob),
+            # we should error out if it doesn't exist
+            self.check_file_exists(src)
+            count += self.process_either(src, dst)
+        return count
 
-        # Let caller check whether we processed as many files as expected. In
-        # particular, let caller notice 0.
+    def strip_debug_info(self, dirs, jobs=None):
+        """
+        Run strip -S on every ELF file under the directories dirs (relative
+        to the destination directory) that still has debug sections, in
+        batches, on jobs (by default, as many as we have CPUs) processes at
+        once. Files are picked by reading their ELF headers, not by name, so
+        data files and scripts are left alone. Returns the number stripped.
+        """
+        if self.plan is not None:
+            print("Not stripping anything while planning")
+            return 0
+        self.wait_for_copies()
+        with self.tracing('strip_debug_info') as trace_args:
+            candidates = []
+            pending = [os.path.join(self.get_dst_prefix(), dir) for dir in dirs]
+            while pending:
+                try:
+                    it = os.scandir(pending.pop())
+                except OSError:
+                    continue
+                with it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            candidates.append(entry.path)
+            jobs = jobs or os.cpu_count() or 1
+            with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+                strip = sorted(path for path, debug in
+                               zip(candidates, pool.map(elf_has_debug_info, candidates))
+                               if debug)
+                print("Stripping %d of %d files (the rest have no debug info or aren't ELF)" %
+                      (len(strip), len(candidates)))
+                # a few files per strip process, but keep every job busy
+                batch = max(1, min(32, len(strip) // jobs))
+                batches = [strip[i:i+batch] for i in range(0, len(strip), batch)]
+                results = pool.map(lambda files: subprocess.call(['strip', '-S'] + files),
+                                   batches)
+                failed = [files for files, rc in zip(batches, results) if rc]
+            # strip rewrites files
+            self.forget_listings()
+            trace_args.update(files=len(candidates), stripped=len(strip))
+            if failed:
+                raise ManifestError("strip -S failed on:\n  " +
+                                    "\n  ".join(itertools.chain.from_iterable(failed)))
+        return len(strip)
+
+    def watch(self, interval, rounds=None):
+        """
+        Poll the files file_list copied from the source tree every interval
+        seconds (for rounds polls, or until interrupted), re-copying each
+        one that changes. Only those files are examined: nothing is resolved
+        again, so it takes milliseconds for an edit to land in the
+        destination tree. New files and subdirectories appearing in a
+        directory that path() copied as a whole are copied too, subject to the
+        same exclusions.
+        """
+        source = os.path.abspath(self.args['source']) + os.path.sep
+        recorded = self.load_state()['files']
+        watched = {}
+        for src, dst in self.file_list:
+            if src and os.path.abspath(src).startswith(source):
+                # Start from the source as it was when we copied it, so that
+                # an edit made since (while finishing, say) gets copied by
+                # the first poll.
+                key = self.fingerprint_key(dst)
+                fingerprint = recorded.get(key) if key else None
+                if fingerprint is not None and fingerprint[0] == src:
+                    watched[src] = [dst, fingerprint[2], fingerprint[1]]
+                    continue
+                try:
+                    st = os.stat(src)
+                except (OSError, TypeError):
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    watched[src] = [dst, st.st_mtime_ns, st.st_size]
+        dirs = dict((src, [dst, self.dir_mtimes.get(listing_path(src))])
+                    for src, dst in self.directory_map.items()
+                    if os.path.abspath(src).startswith(source))
+        print("Watching %d files in %d directories for changes (Ctrl-C to stop)" %
+              (len(watched), len(set(os.path.dirname(src) for src in watched))))
+        sys.stdout.flush()
+        try:
+            while rounds is None or rounds > 0:
+                if rounds is not None:
+                    rounds -= 1
+                time.sleep(interval)
+                changed = self.poll_watched(watched, dirs)
+                if changed:
+                    self.save_state()
+                    sys.stdout.flush()
+        except KeyboardInterrupt:
+            print("Stopped watching")
+
+    def poll_watched(self, watched, dirs):
+        """
+        One round of watch(): copy every file in watched (src -> [dst,
+        mtime, size]) whose mtime or size has changed, and any new file or
+        directory in one of dirs (src -> [dst, mtime]). Returns the number
+        of files copied.
+        """
+        changed = 0
+        for src, (dst, mtime, size) in list(watched.items()):
+            try:
+                st = os.stat(src)
+            except OSError:
+                print("%s has gone: no longer watching it" % src)
+                del watched[src]
+                continue
+            if (st.st_mtime_ns, st.st_size) == (mtime, size):
+                continue
+            start = time.perf_counter()
+            watched[src] = [dst, st.st_mtime_ns, st.st_size]
+            # An edit in place leaves the directory's mtime alone, so
+            # rescan_if_changed() wouldn't notice: make ccopyfile() see the
+            # file as it is now.
+            self.dir_entries.pop(listing_path(os.path.dirname(src)), None)
+            if self.includes(src, dst):
+                self.ccopyfile(src, dst)
+                changed += 1
+                print("Updated %s (%.1f ms)" %
+                      (self._relative_dst_path(dst), (time.perf_counter() - start) * 1000))
+
+        for srcdir, entry in list(dirs.items()):
+            dstdir, mtime = entry
+            try:
+                now = os.stat(srcdir).st_mtime_ns
+            except OSError:
+                continue
+            if now == mtime:
+                continue
+            entry[1] = now
+            self.rescan_if_changed(srcdir)
+            for name, dirent in list(self.scan_dir(srcdir).items()):
+                src = os.path.join(srcdir, name)
+                dst = os.path.join(dstdir, name)
+                if src in watched or src in dirs or dirent.is_symlink():
+                    continue
+                if dirent.is_dir(follow_symlinks=False):
+                    changed += self.watch_new_directory(src, dst, watched, dirs)
+                    continue
+                if not dirent.is_file(follow_symlinks=False) or not self.includes(src, dst):
+                    continue
+                st = dirent.stat()
+                watched[src] = [dst, st.st_mtime_ns, st.st_size]
+                self.cmakedirs(dstdir)
+                self.ccopyfile(src, dst)
+                self.file_list.append([src, dst])
+                changed += 1
+                print("Added %s" % self._relative_dst_path(dst))
+        return changed
+
+    def watch_new_directory(self, src, dst, watched, dirs):
+        """
+        For poll_watched(): copy directory src, which has just appeared in a
+        directory copied as a whole, to dst, and add the files and
+        directories in it to watched and dirs. Returns the number of files
+        copied.
+        """
+        first = len(self.file_list)
+        count = self.process_directory(src, dst)
+        self.wait_for_copies()
+        for new_src, new_dst in self.file_list[first:]:
+            try:
+                st = os.stat(new_src)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                watched[new_src] = [new_dst, st.st_mtime_ns, st.st_size]
+        below = src + os.path.sep
+        for dir, dir_dst in self.directory_map.items():
+            if (dir == src or dir.startswith(below)) and dir not in dirs:
+                dirs[dir] = [dir_dst, self.dir_mtimes.get(listing_path(dir))]
+        if count:
+            print("Added %s (%d files)" % (self._relative_dst_path(dst), count))
         return count
 
     def do(self, *actions):
         self.actions = actions
-        self.construct()
-        # perform finish actions
-        # generic finish first
-        self.finish()
-        for action in self.actions:
-            methodname = action + "_finish"
-            method = getattr(self, methodname, None)
-            if method is not None:
-                method()
+        check_only = 'check' in actions
+        plan_only = 'plan' in actions or check_only
+        if plan_only or self.args.get('plan'):
+            # checking records (and discards) a plan, just so that nothing
+            # construct() does touches the disk
+            self.plan = ManifestPlan()
+        if check_only:
+            self.check_pool = concurrent.futures.ThreadPoolExecutor(CHECK_JOBS)
+        try:
+            with self.tracing('construct', 'construct', manifest=type(self).__name__,
+                              dest=self.get_dst_prefix()):
+                self.construct()
+                self.wait_for_copies()
+            if check_only:
+                with self.tracing('collect_checks'):
+                    self.collect_checks()
+                self.plan = None
+            if self.plan is not None:
+                with self.tracing('execute_plan'):
+                    self.execute_plan(dump_to=self.args.get('plan'), execute=not plan_only)
+            # perform finish actions
+            # generic finish first
+            with self.tracing('finish', 'finish'):
+                self.finish()
+            for action in ([] if plan_only else self.actions):
+                methodname = action + "_finish"
+                method = getattr(self, methodname, None)
+                if method is not None:
+                    with self.tracing(methodname, 'finish'):
+                        method()
+                        self.wait_for_copies()
+            self.package_tree_ready()
+            self.save_state()
+            if self.args.get('watch') and 'copy' in actions and not plan_only:
+                self.watch(float(self.args['watch']))
+        finally:
+            self.plan = None
+            if self.check_pool is not None:
+                self.check_pool.shutdown()
+                self.check_pool = None
+            if self.copy_pool is not None:
+                self.copy_pool.shutdown()
+                self.copy_pool = None
+            if self.trace is not None:
+                self.trace.write()
         return self.file_list
+
+    def execute_plan(self, dump_to=None, execute=True):
+        """
+        Stop recording: optimise the plan construct() produced, dump it as
+        JSON if requested, and carry it out unless execute is False.
+        """
+        plan, self.plan = self.plan, None
+        plan.optimise()
+        print("Plan:", plan.summary())
+        if dump_to:
+            plan.dump(dump_to)
+            print("Wrote plan to", dump_to)
+        if execute:
+            plan.execute(self)
@@ -0,0 +1,679 @@
+#!/usr/bin/env python3
+"""\
+@file test_llmanifest.py
+@brief Tests for LLManifest's copying and packaging machinery, against small
+       scratch source and destination trees.
+
+$LicenseInfo:firstyear=2026&license=viewerlgpl$
+Second Life Viewer Source Code
+Copyright (C) 2026, Linden Research, Inc.
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation;
+version 2.1 of the License only.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+Linden Research, Inc., 945 Battery Street, San Francisco, CA  94111  USA
+$/LicenseInfo$
+"""
+import contextlib
+import fnmatch
+import io
+import json
+import os
+import random
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+from indra.util import llmanifest
+
+class ScratchManifest(llmanifest.LLManifest):
+    """
+    Runs whatever construct function the test supplies, and counts the
+    files it actually copies.
+    """
+    def __init__(self, args, build):
+        super(ScratchManifest, self).__init__(args)
+        self.build = build
+        self.copied = []
+
+    def construct(self):
+        super(ScratchManifest, self).construct()
+        self.build(self)
+
+    def clone_file(self, src, dst):
+        self.copied.append(dst)
+        super(ScratchManifest, self).clone_file(src, dst)
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='llmanifest-test-')
+        self.source = os.path.join(self.tempdir, 'source')
+        self.build = os.path.join(self.tempdir, 'build')
+        self.dest = os.path.join(self.tempdir, 'dest')
+        os.makedirs(self.source)
+        os.makedirs(self.build)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, path, data):
+        dir = os.path.dirname(path)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def make_manifest(self, build, **args):
+        return ScratchManifest(dict(dict(
+            source=self.source, artwork=self.source, build=self.build,
+            dest=self.dest, grid='default', platform='linux', arch='x86_64',
+            version=['1', '2', '3', '4'], configuration='Release',
+            buildtype='Release', channel='Second Life Test'), **args), build)
+
+    def run_manifest(self, build, *actions, **args):
+        manifest = self.make_manifest(build, **args)
+        with contextlib.redirect_stdout(io.StringIO()):
+            manifest.do(*(actions or ('copy',)))
+        return manifest
+
+def make_elf(names, bits=64, order='<', xindex=False):
+    """
+    The bytes of a minimal ELF file (header, section name table, section
+    headers and nothing else) with sections named names, after the null
+    section 0 and before .shstrtab. With xindex, the section count and name
+    table index are escaped into section 0, as for files with very many
+    sections.
+    """
+    names = [''] + list(names) + ['.shstrtab']
+    strtab = b'\0'
+    offsets = []
+    for name in names:
+        if name:
+            offsets.append(len(strtab))
+            strtab += name.encode('ascii') + b'\0'
+        else:
+            offsets.append(0)
+    header_fmt, section_fmt = {32: ('HHIIIIIHHHHHH', 'IIIIIIIIII'),
+                               64: ('HHIQQQIHHHHHH', 'IIQQQQIIQQ')}[bits]
+    ehsize = 16 + struct.calcsize(order + header_fmt)
+    shentsize = struct.calcsize(order + section_fmt)
+    shoff = ehsize + len(strtab)
+    shnum, shstrndx = len(names), len(names) - 1
+    sections = b''
+    for index, offset in enumerate(offsets):
+        if index == shstrndx:
+            where, size, link = ehsize, len(strtab), 0
+        elif index == 0 and xindex:
+            where, size, link = 0, shnum, shstrndx
+        else:
+            where, size, link = 0, 0, 0
+        sections += struct.pack(order + section_fmt, offset, 0, 0, 0, where, size, link, 0, 0, 0)
+    ident = b'\x7fELF' + bytes([bits // 32, {'<': 1, '>': 2}[order], 1]) + bytes(9)
+    header = struct.pack(order + header_fmt, 2, 0, 1, 0, 0, shoff, 0, ehsize, 0, 0,
+                         shentsize, 0 if xindex else shnum, 0xFFFF if xindex else shstrndx)
+    return ident + header + strtab + sections
+
+class TestElf(ManifestTestCase):
+    def elf(self, data):
+        path = os.path.join(self.tempdir, 'file')
+        self.write(path, data)
+        return llmanifest.elf_section_names(path), llmanifest.elf_has_debug_info(path)
+
+    def test_layouts(self):
+        names = ['.text', '.debug_info', '.data']
+        for bits in (32, 64):
+            for order in '<>':
+                for xindex in (False, True):
+                    self.assertEqual(self.elf(make_elf(names, bits, order, xindex)),
+                                     ([''] + names + ['.shstrtab'], True),
+                                     (bits, order, xindex))
+
+    def test_debug_sections(self):
+        self.assertEqual(self.elf(make_elf(['.text', '.zdebug_line']))[1], True)
+        self.assertEqual(self.elf(make_elf(['.text', '.debuglink_not']))[1], True)
+        self.assertEqual(self.elf(make_elf(['.text', '.gnu_debuglink']))[1], False)
+
+    def test_no_section_headers(self):
+        data = bytearray(make_elf(['.text']))
+        struct.pack_into('<Q', data, 0x28, 0)
+        self.assertEqual(self.elf(bytes(data)), ([], False))
+
+    def test_not_elf(self):
+        self.assertEqual(self.elf(b''), (None, False))
+        self.assertEqual(self.elf(b'#!/bin/sh\necho hello\n' * 10), (None, False))
+        data = make_elf(['.debug_info'])
+        # unknown class, then unknown byte order
+        self.assertEqual(self.elf(data[:4] + b'\x03' + data[5:]), (None, False))
+        self.assertEqual(self.elf(data[:5] + b'\x03' + data[6:]), (None, False))
+
+    def test_truncated(self):
+        data = make_elf(['.text', '.debug_info'])
+        for size in (4, 40, 63, len(data) - 1):
+            self.assertEqual(self.elf(data[:size]), (None, False), size)
+        # a section name table that runs past the end of the file
+        data = bytearray(data)
+        shoff, = struct.unpack_from('<Q', data, 0x28)
+        struct.pack_into('<Q', data, shoff + 3 * 64 + 0x20, len(data))
+        self.assertEqual(self.elf(bytes(data)), (None, False))
+
+class TestNormalizeModes(ManifestTestCase):
+    # what LinuxManifest.package_finish() passes
+    file_modes = {0o700: 0o755, 0o500: 0o555, 0o600: 0o644, 0o400: 0o444}
+
+    def setUp(self):
+        super(TestNormalizeModes, self).setUp()
+        self.template = os.path.join(self.tempdir, 'template')
+        for index, mode in enumerate((0o700, 0o500, 0o600, 0o400, 0o664, 0o755, 0o711, 0o640)):
+            for dir in ('', 'sub', os.path.join('sub', 'deeper'), 'other'):
+                path = os.path.join(self.template, dir, 'f%d' % index)
+                self.write(path, b'x')
+                os.chmod(path, mode)
+        for dir, mode in (('sub', 0o700), (os.path.join('sub', 'deeper'), 0o775), ('other', 0o750)):
+            os.chmod(os.path.join(self.template, dir), mode)
+        # a symlink to a file outside the tree, whose mode must survive
+        self.outside = os.path.join(self.tempdir, 'outside')
+        self.write(self.outside, b'y')
+        os.chmod(self.outside, 0o600)
+        os.symlink(self.outside, os.path.join(self.template, 'sub', 'link'))
+
+    def modes(self, top):
+        result = {}
+        for dir, dirs, files in os.walk(top):
+            for name in [''] + dirs + files:
+                path = os.path.join(dir, name)
+                result[os.path.relpath(path, top)] = os.lstat(path).st_mode
+        return result
+
+    def copy(self, name):
+        top = os.path.join(self.tempdir, name)
+        shutil.copytree(self.template, top, symlinks=True)
+        return top
+
+    def find_chmod(self):
+        # what package_finish() used to run
+        top = self.copy('find')
+        try:
+            subprocess.check_call(['find', top, '-type', 'd', '-exec', 'chmod', '755', '{}', ';'])
+            for old, new in ('0700', '0755'), ('0500', '0555'), ('0600', '0644'), ('0400', '0444'):
+                subprocess.check_call(['find', top, '-type', 'f', '-perm', old,
+                                       '-exec', 'chmod', new, '{}', ';'])
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest("no find and chmod here")
+        return self.modes(top)
+
+    def check(self, name):
+        expected = self.find_chmod()
+        top = self.copy(name)
+        before = self.modes(top)
+        changed = llmanifest.normalize_modes(top, 0o755, self.file_modes)
+        self.assertEqual(self.modes(top), expected)
+        self.assertEqual(changed, sum(before[path] != mode for path, mode in expected.items()))
+        self.assertTrue(stat.S_ISLNK(os.lstat(os.path.join(top, 'sub', 'link')).st_mode))
+        self.assertEqual(stat.S_IMODE(os.stat(self.outside).st_mode), 0o600)
+        # and again, with nothing left to do
+        self.assertEqual(llmanifest.normalize_modes(top, 0o755, self.file_modes), 0)
+
+    def test_fd_walk(self):
+        if not (os.scandir in os.supports_fd and os.chmod in os.supports_dir_fd):
+            self.skipTest("no fchmodat() here")
+        self.check('fd')
+
+    def test_path_walk(self):
+        with mock.patch.object(llmanifest.os, 'supports_fd', set()):
+            self.check('path')
+
+class TestExclusions(ManifestTestCase):
+    pieces = ['a', 'b', 'ab', '.so', os.path.sep, '*', '?', '[ab]', '[!a]']
+
+    def random_pattern(self, rng):
+        return ''.join(rng.choice(self.pieces) for i in range(rng.randint(1, 6)))
+
+    def random_path(self, rng, top=''):
+        path = top
+        for i in range(rng.randint(1, 4)):
+            path = os.path.join(path, ''.join(rng.choice('ab.so') for j in range(rng.randint(1, 3))))
+        return path
+
+    def excluding(self, patterns):
+        manifest = self.make_manifest(lambda m: None)
+        for pattern in patterns:
+            manifest.exclude(pattern)
+        return manifest
+
+    def excluded(self, path, patterns):
+        return any(fnmatch.fnmatch(path, pattern) for pattern in patterns)
+
+    def test_matches_fnmatch(self):
+        rng = random.Random(5)
+        for trial in range(300):
+            patterns = [self.random_pattern(rng) for i in range(rng.randint(1, 3))]
+            manifest = self.excluding(patterns)
+            for i in range(30):
+                path = self.random_path(rng)
+                self.assertEqual(manifest.includes(path, path), not self.excluded(path, patterns),
+                                 (path, patterns))
+
+    def test_later_exclusions(self):
+        manifest = self.excluding(['*.so'])
+        self.assertTrue(manifest.includes('x.txt', 'x.txt'))
+        manifest.exclude('*.txt')
+        self.assertFalse(manifest.includes('x.txt', 'x.txt'))
+
+    def test_subtree_pruning(self):
+        rng = random.Random(7)
+        pruned = 0
+        for trial in range(300):
+            patterns = [self.random_pattern(rng) for i in range(rng.randint(1, 3))]
+            manifest = self.excluding(patterns)
+            for i in range(30):
+                dir = self.random_path(rng)
+                if not manifest.excludes_subtree(dir):
+                    continue
+                pruned += 1
+                for j in range(10):
+                    path = self.random_path(rng, dir)
+                    self.assertTrue(self.excluded(path, patterns), (dir, path, patterns))
+        # the pruning does happen
+        self.assertTrue(pruned > 100, pruned)
+
+    def test_subtree_examples(self):
+        manifest = self.excluding([os.path.join('*', 'tests', '*'), '*.pdb'])
+        self.assertTrue(manifest.excludes_subtree(os.path.join('src', 'tests')))
+        self.assertTrue(manifest.excludes_subtree(os.path.join('src', 'tests', 'deeper')))
+        self.assertFalse(manifest.excludes_subtree(os.path.join('src', 'testsuite')))
+        self.assertFalse(manifest.excludes_subtree(os.path.join('src', 'bin.pdb')))
+        self.assertFalse(self.excluding([]).excludes_subtree('src'))
+
+class TestUpToDate(ManifestTestCase):
+    def setUp(self):
+        super(TestUpToDate, self).setUp()
+        self.src = os.path.join(self.source, 'data.bin')
+        self.dst = os.path.join(self.dest, 'data.bin')
+        self.write(self.src, b'a' * 1000)
+
+    def copy(self):
+        return self.run_manifest(lambda m: m.path('data.bin')).copied
+
+    def test_no_op(self):
+        self.assertEqual(self.copy(), [self.dst])
+        self.assertEqual(self.copy(), [])
+        self.assertEqual(self.read(self.dst), b'a' * 1000)
+
+    def test_source_edit(self):
+        self.copy()
+        self.write(self.src, b'b' * 1000)
+        st = os.stat(self.src)
+        os.utime(self.src, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(self.copy(), [self.dst])
+        self.assertEqual(self.read(self.dst), b'b' * 1000)
+
+    def test_destination_edit(self):
+        self.copy()
+        # changed in place, as strip or signing would: same inode
+        with open(self.dst, 'r+b') as f:
+            f.truncate(10)
+        self.assertEqual(self.copy(), [self.dst])
+        self.assertEqual(self.read(self.dst), b'a' * 1000)
+        self.assertEqual(self.copy(), [])
+
+class TestHardLinks(ManifestTestCase):
+    def check_package_unlinks(self, copy_mode):
+        packages = os.path.join(self.tempdir, 'packages')
+        src = os.path.join(packages, 'lib', 'libx.so')
+        dst = os.path.join(self.dest, 'lib', 'libx.so')
+        self.write(src, b'x' * 3000)
+
+        def build(manifest):
+            with manifest.prefix(src=os.path.join(manifest.packages_dir(), 'lib'), dst='lib'):
+                manifest.path('libx.so')
+
+        self.run_manifest(build, 'copy', copy_mode=copy_mode)
+        if not os.path.samefile(src, dst):
+            self.skipTest("this filesystem reflinks or can't hard-link")
+        for run in range(2):
+            manifest = self.run_manifest(build, 'copy', 'package', copy_mode=copy_mode)
+            self.assertEqual(manifest.copied, [] if run else [dst])
+            self.assertFalse(os.path.samefile(src, dst))
+        # what packaging might then do to dst leaves the package alone
+        with open(dst, 'r+b') as f:
+            f.truncate(5)
+        self.assertEqual(self.read(src), b'x' * 3000)
+
+    def test_auto(self):
+        self.check_package_unlinks('auto')
+
+    def test_hardlink(self):
+        self.check_package_unlinks('hardlink')
+
+class TestResolvePath(ManifestTestCase):
+    def sources(self, *args):
+        manifest = self.run_manifest(lambda m: m.path('lib.so'), *args)
+        return [src for src, dst in manifest.file_list], manifest.missing
+
+    def test_later_prefix(self):
+        self.write(os.path.join(self.build, 'lib.so'), b'build')
+        self.assertEqual(self.sources(), ([os.path.join(self.build, 'lib.so')], []))
+        # an earlier prefix still wins once it has the file
+        self.write(os.path.join(self.source, 'lib.so'), b'source')
+        self.assertEqual(self.sources(), ([os.path.join(self.source, 'lib.so')], []))
+
+    def test_missing(self):
+        with self.assertRaises(llmanifest.MissingError):
+            self.sources()
+        self.assertEqual(self.run_manifest(lambda m: m.path_optional('lib.so')).file_list, [])
+
+class TestPathMany(ManifestTestCase):
+    def setUp(self):
+        super(TestPathMany, self).setUp()
+        self.artwork = os.path.join(self.tempdir, 'artwork')
+        self.write(os.path.join(self.source, 'a.txt'), b'a')
+        self.write(os.path.join(self.build, 'a.txt'), b'shadowed')
+        self.write(os.path.join(self.build, 'b.txt'), b'b')
+        self.write(os.path.join(self.artwork, 'art', 'c.png'), b'c')
+        self.write(os.path.join(self.artwork, 'art', 'd.png'), b'd')
+        self.write(os.path.join(self.build, 'e1.dat'), b'e')
+        self.write(os.path.join(self.build, 'e2.dat'), b'e')
+        self.names = ['b.txt', 'art', 'missing.txt', 'a.txt', 'e*.dat', 'gone.txt']
+
+    def results(self, build):
+        manifest = self.make_manifest(build, artwork=self.artwork)
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(llmanifest.MissingError):
+                manifest.do('copy')
+        return manifest.file_list, manifest.missing
+
+    def check(self, dst):
+        def many(manifest):
+            with manifest.prefix(dst='out'):
+                manifest.path_many(self.names, dst)
+
+        def one_by_one(manifest):
+            with manifest.prefix(dst='out'):
+                for name in self.names:
+                    manifest.path(name, name if dst is None else os.path.join(dst, name))
+
+        expected = self.results(one_by_one)
+        self.assertEqual(self.results(many), expected)
+        self.assertEqual(len(expected[0]), 6)
+        self.assertEqual([m.pattern for m in expected[1]], ['missing.txt', 'gone.txt'])
+
+    def test_same_as_path(self):
+        self.check(None)
+
+    def test_same_as_path_with_dst(self):
+        self.check('sub')
+
+class TestDedupe(ManifestTestCase):
+    def setUp(self):
+        super(TestDedupe, self).setUp()
+        for name in ('a.bin', 'b.bin', 'c.bin'):
+            self.write(os.path.join(self.source, name), b'd' * 5000)
+
+    def dedupe(self, *actions, **args):
+        return self.run_manifest(lambda m: m.path('*.bin'), *actions,
+                                 **dict(dict(dedupe='symlink'), **args)).copied
+
+    def links(self):
+        return sorted(name for name in os.listdir(self.dest)
+                      if os.path.islink(os.path.join(self.dest, name)))
+
+    def edit(self, name, data):
+        path = os.path.join(self.source, name)
+        st = os.stat(path)
+        self.write(path, data)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def test_rerun(self):
+        self.assertEqual(len(self.dedupe('copy', 'unpacked')), 3)
+        self.assertEqual(self.links(), ['b.bin', 'c.bin'])
+        self.assertEqual(self.dedupe('copy', 'unpacked'), [])
+        # nor does a plain copy undo it
+        self.assertEqual(self.dedupe('copy'), [])
+        self.assertEqual(self.links(), ['b.bin', 'c.bin'])
+
+    def test_linked_source_edit(self):
+        self.dedupe('copy', 'unpacked')
+        self.edit('a.bin', b'e' * 5000)
+        self.assertEqual(len(self.dedupe('copy')), 3)
+        self.assertEqual(self.links(), [])
+        self.assertEqual(self.read(os.path.join(self.dest, 'a.bin')), b'e' * 5000)
+        self.assertEqual(self.read(os.path.join(self.dest, 'b.bin')), b'd' * 5000)
+
+    def test_own_source_edit(self):
+        self.dedupe('copy', 'unpacked')
+        self.edit('b.bin', b'e' * 5000)
+        self.assertEqual(self.dedupe('copy'), [os.path.join(self.dest, 'b.bin')])
+        self.assertEqual(self.links(), ['c.bin'])
+        self.assertEqual(self.read(os.path.join(self.dest, 'b.bin')), b'e' * 5000)
+
+    def test_hardlink(self):
+        self.dedupe('copy', 'unpacked', dedupe='hardlink')
+        self.assertTrue(os.path.samefile(os.path.join(self.dest, 'a.bin'),
+                                         os.path.join(self.dest, 'c.bin')))
+        self.assertEqual(self.dedupe('copy', 'unpacked', dedupe='hardlink'), [])
+
+class TestSymlinkedBuild(ManifestTestCase):
+    def test_packages_beside_real_build(self):
+        # build is a symlink to elsewhere/build, so build/../packages is
+        # elsewhere/packages, not the packages directory next to build
+        elsewhere = os.path.join(self.tempdir, 'elsewhere')
+        os.makedirs(os.path.join(elsewhere, 'build'))
+        os.rmdir(self.build)
+        os.symlink(os.path.join(elsewhere, 'build'), self.build)
+        self.write(os.path.join(elsewhere, 'packages', 'lib', 'libx.so'), b'x' * 100)
+        self.write(os.path.join(elsewhere, 'packages', 'lib', 'liby.so'), b'y' * 100)
+
+        def build(manifest):
+            with manifest.prefix(src=os.path.join(manifest.packages_dir(), 'lib'), dst='lib'):
+                manifest.path('libx.so')
+                manifest.path('liby*.so')
+
+        self.run_manifest(build)
+        self.assertEqual(self.read(os.path.join(self.dest, 'lib', 'libx.so')), b'x' * 100)
+        self.assertEqual(self.read(os.path.join(self.dest, 'lib', 'liby.so')), b'y' * 100)
+
+class TestArtifacts(ManifestTestCase):
+    def setUp(self):
+        super(TestArtifacts, self).setUp()
+        self.write(os.path.join(self.source, 'top', 'tree', 'sub', 'file.txt'), b'one')
+        self.write(os.path.join(self.source, 'whole', 'sub', 'file.txt'), b'two')
+        self.tarball = os.path.join(self.source, 'unpacked_linux_1_2_3_4.tar')
+
+    def contents(self, manifest):
+        with manifest.prefix(src='top', dst='top'):
+            # matches a directory, which gets copied whole
+            manifest.path('*')
+        manifest.copy_action(manifest.src_path_of('whole'), manifest.dst_path_of('whole'))
+
+    def is_current(self):
+        return self.run_manifest(self.contents).artifact_is_current(self.tarball)
+
+    def touch(self, path):
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def test_unchanged(self):
+        self.run_manifest(self.contents, 'copy', 'unpacked')
+        self.assertTrue(self.is_current())
+
+    def test_deterministic(self):
+        os.chmod(os.path.join(self.source, 'whole', 'sub', 'file.txt'), 0o664)
+        os.utime(os.path.join(self.source, 'whole', 'sub', 'file.txt'), (1700000000, 1700000000))
+        self.run_manifest(self.contents, 'copy', 'unpacked')
+        with tarfile.open(self.tarball) as tf:
+            members = tf.getmembers()
+        self.assertEqual([m.name for m in members], sorted(m.name for m in members))
+        mtime = max(m.mtime for m in members)
+        self.assertTrue(mtime >= 1700000000)
+        for member in members:
+            self.assertEqual(member.mtime, mtime)
+            self.assertEqual(member.mode, 0o755 if member.isdir() else 0o644)
+            self.assertEqual((member.uid, member.uname), (0, ''))
+
+    def test_edit_in_globbed_directory(self):
+        self.run_manifest(self.contents, 'copy', 'unpacked')
+        self.touch(os.path.join(self.source, 'top', 'tree', 'sub', 'file.txt'))
+        self.assertFalse(self.is_current())
+
+    def test_edit_in_copied_directory(self):
+        self.run_manifest(self.contents, 'copy', 'unpacked')
+        self.touch(os.path.join(self.source, 'whole', 'sub', 'file.txt'))
+        self.assertFalse(self.is_current())
+
+    def test_newest_input_mtime(self):
+        newest = os.path.join(self.source, 'whole', 'sub', 'file.txt')
+        os.utime(newest, (1700000000, 1700000000))
+        for dir, dirs, files in os.walk(self.source):
+            for name in dirs + [f for f in files if f != 'file.txt']:
+                os.utime(os.path.join(dir, name), (1600000000, 1600000000))
+        os.utime(os.path.join(self.source, 'top', 'tree', 'sub', 'file.txt'), (1600000000, 1600000000))
+        manifest = self.run_manifest(self.contents)
+        self.assertEqual(manifest.newest_input_mtime(), 1700000000)
+
+class TestPlan(ManifestTestCase):
+    def test_untar_members(self):
+        self.write(os.path.join(self.tempdir, 'stuff', 'a.txt'), b'a')
+        with tarfile.open(os.path.join(self.source, 'stuff.tar'), 'w') as tf:
+            tf.add(os.path.join(self.tempdir, 'stuff', 'a.txt'), 'stuff/a.txt')
+        plan = os.path.join(self.tempdir, 'plan.json')
+        self.run_manifest(lambda m: m.contents_of_tar('stuff.tar', 'out'), 'copy', plan=plan)
+        with open(plan) as f:
+            ops = [op for op in json.load(f)['ops'] if op['op'] == 'untar']
+        self.assertEqual([op['member'] for op in ops], ['stuff/a.txt'])
+        self.assertEqual(self.read(os.path.join(self.dest, 'out', 'stuff', 'a.txt')), b'a')
+
+    def test_optimise(self):
+        plan = llmanifest.ManifestPlan()
+        plan.add('mkdir', dst='d/e')
+        plan.add('mkdir', dst='d')
+        plan.add('copy', 'a', 'd/x')
+        plan.add('copy', 'a', 'd/x')
+        plan.add('command', data=['touch', 'd/x'])
+        plan.add('mkdir', dst='d/e')
+        plan.add('copy', 'a', 'd/x')
+        plan.optimise()
+        self.assertEqual([(op.op, op.dst) for op in plan.ops],
+                         [('mkdir', 'd/e'), ('copy', 'd/x'), ('command', None),
+                          ('mkdir', 'd/e'), ('copy', 'd/x')])
+
+    def snapshot(self, top):
+        result = {}
+        for dir, dirs, files in os.walk(top):
+            for name in dirs + files:
+                path = os.path.join(dir, name)
+                rel = os.path.relpath(path, top)
+                if os.path.islink(path):
+                    result[rel] = ('link', os.readlink(path))
+                elif os.path.isdir(path):
+                    result[rel] = ('dir',)
+                else:
+                    result[rel] = ('file', self.read(path))
+        return result
+
+    def test_execute_matches_direct(self):
+        self.write(os.path.join(self.source, 'a.txt'), b'a')
+        self.write(os.path.join(self.source, 'tree', 'sub', 'b.txt'), b'b')
+        os.symlink('a.txt', os.path.join(self.source, 'alias.txt'))
+        self.write(os.path.join(self.tempdir, 'stuff', 'c.txt'), b'c')
+        with tarfile.open(os.path.join(self.source, 'stuff.tar'), 'w') as tf:
+            tf.add(os.path.join(self.tempdir, 'stuff', 'c.txt'), 'stuff/c.txt')
+
+        def contents(manifest):
+            x = manifest.dst_path_of(os.path.join('out', 'x.txt'))
+            with manifest.prefix(dst='out'):
+                manifest.path('a.txt', 'x.txt')
+                manifest.run_command([sys.executable, '-c',
+                                      "open(%r, 'w').write('changed')" % x])
+                # must undo what the command did
+                manifest.path('a.txt', 'x.txt')
+                manifest.path('tree')
+                manifest.path('alias.txt')
+                manifest.put_in_file(b'generated', 'gen.txt')
+                manifest.make_symlink('a.txt', manifest.dst_path_of('made'))
+            manifest.contents_of_tar('stuff.tar', 'untarred')
+
+        direct = os.path.join(self.tempdir, 'direct')
+        self.run_manifest(contents, dest=direct)
+        self.run_manifest(contents, plan=os.path.join(self.tempdir, 'plan.json'))
+        self.assertEqual(self.snapshot(self.dest), self.snapshot(direct))
+        self.assertEqual(self.read(os.path.join(self.dest, 'out', 'x.txt')), b'a')
+
+class StrippingManifest(ScratchManifest):
+    """Shrinks every file while packaging, as stripping binaries does."""
+    call_hook = True
+
+    def package_finish(self):
+        for src, dst in self.file_list:
+            with open(dst, 'r+b') as f:
+                f.truncate(10)
+        if self.call_hook:
+            self.package_tree_ready()
+
+class TestSizeReport(ManifestTestCase):
+    def report_total(self, call_hook):
+        self.write(os.path.join(self.source, 'big.so'), b'x' * 1000)
+        report = os.path.join(self.tempdir, 'sizes.json')
+        manifest = StrippingManifest(dict(
+            source=self.source, artwork=self.source, build=self.build,
+            dest=self.dest, grid='default', platform='linux', arch='x86_64',
+            version=['1', '2', '3', '4'], configuration='Release',
+            buildtype='Release', channel='Second Life Test', size_report=report),
+            lambda m: m.path('big.so'))
+        manifest.call_hook = call_hook
+        with contextlib.redirect_stdout(io.StringIO()):
+            manifest.do('copy', 'package')
+        with open(report) as f:
+            return json.load(f)['total']
+
+    def test_after_package_changes(self):
+        self.assertEqual(self.report_total(True), 10)
+
+    def test_without_hook(self):
+        self.assertEqual(self.report_total(False), 10)
+
+class TestWatch(ManifestTestCase):
+    def setUp(self):
+        super(TestWatch, self).setUp()
+        self.write(os.path.join(self.source, 'shaders', 'a.glsl'), b'one')
+        self.manifest = self.run_manifest(lambda m: m.path('shaders'))
+
+    def poll(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.manifest.watch(0, rounds=1)
+
+    def test_edit_before_watching(self):
+        # edited after the copy but before watch() starts looking
+        src = os.path.join(self.source, 'shaders', 'a.glsl')
+        self.write(src, b'two!')
+        self.poll()
+        self.assertEqual(self.read(os.path.join(self.dest, 'shaders', 'a.glsl')), b'two!')
+
+    def test_new_subdirectory(self):
+        self.write(os.path.join(self.source, 'shaders', 'new', 'deeper', 'b.glsl'), b'b')
+        self.poll()
+        self.assertEqual(self.read(os.path.join(self.dest, 'shaders', 'new', 'deeper', 'b.glsl')), b'b')
+
+if __name__ == '__main__':
+    unittest.main()
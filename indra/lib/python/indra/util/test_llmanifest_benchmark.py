@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""\
+@file test_llmanifest_benchmark.py
+@brief Benchmarks for LLManifest against synthetic source, artwork and build trees.
+
+Run with pytest (or directly). The scale is set by environment variables:
+
+LLMANIFEST_BENCH_FILES     approximate number of files to generate (default
+                           1000; try 10000 or 100000)
+LLMANIFEST_BENCH_OUTPUT    if set, append the measurements to this file, one
+                           JSON object per line
+LLMANIFEST_BENCH_BASELINE  if set, a file written via LLMANIFEST_BENCH_OUTPUT:
+                           fail any scenario that takes more than
+                           LLMANIFEST_BENCH_TOLERANCE (default 0.5, i.e. 50%)
+                           longer than the last run recorded there at the
+                           same scale
+LLMANIFEST_BENCH_PACKAGE   a packaged viewer tree (e.g. the installer
+                           directory the Linux package action tars up) to
+                           compress in the tarball codec benchmark, instead
+                           of a synthetic one
+
+$LicenseInfo:firstyear=2026&license=viewerlgpl$
+Second Life Viewer Source Code
+Copyright (C) 2026, Linden Research, Inc.
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation;
+version 2.1 of the License only.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+Linden Research, Inc., 945 Battery Street, San Francisco, CA  94111  USA
+$/LicenseInfo$
+"""
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import unittest
+
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+from indra.util import llmanifest
+
+SCALE = int(os.environ.get('LLMANIFEST_BENCH_FILES', '1000'))
+
+# os functions whose calls we count: the ones LLManifest (and shutil on its
+# behalf) uses to probe and populate trees
+COUNTED_CALLS = ('stat', 'lstat', 'scandir', 'listdir', 'open', 'link', 'symlink',
+                 'unlink', 'remove', 'mkdir', 'makedirs', 'readlink', 'utime', 'chmod')
+
+class BenchmarkManifest(llmanifest.LLManifest):
+    """
+    Exercises the usual kinds of manifest statement: a wide directory by
+    glob, a deep tree via path() and via copy_action() (ccopytree()),
+    symlinks, artwork globs and single files that are only found in the
+    build tree.
+    """
+    def construct(self):
+        super(BenchmarkManifest, self).construct()
+        with self.prefix(src_dst="wide"):
+            self.path("*.dat")
+        self.path("deep")
+        self.copy_action(self.src_path_of("deep"), self.dst_path_of("deep_tree"))
+        with self.prefix(src_dst="links"):
+            self.path("*")
+        with self.prefix(src_dst="skins"):
+            self.path("*.png")
+        with self.prefix(src="bin", build="bin", dst="bin"):
+            for name in self.args['build_names']:
+                self.path(name)
+
+def make_trees(root, count):
+    """
+    Create source, artwork and build trees under root holding roughly count
+    files in all. Returns (args for BenchmarkManifest, number of files it
+    should copy).
+    """
+    source = os.path.join(root, 'source')
+    artwork = os.path.join(root, 'artwork')
+    build = os.path.join(root, 'build')
+    content = b'x' * 100
+
+    def write(path):
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    wide = max(1, count // 2)
+    deep = max(1, count // 4)
+    built = max(1, count // 8)
+    skins = max(1, count - wide - deep - built)
+    links = max(1, count // 100)
+
+    os.makedirs(os.path.join(source, 'wide'))
+    for i in range(wide):
+        write(os.path.join(source, 'wide', 'f%06d.dat' % i))
+
+    # ten files per directory, the directories nested four wide
+    for i in range(deep):
+        digits = []
+        n = i // 10
+        while True:
+            digits.append('d%d' % (n % 4))
+            n //= 4
+            if not n:
+                break
+        dir = os.path.join(source, 'deep', *digits)
+        os.makedirs(dir, exist_ok=True)
+        write(os.path.join(dir, 'g%06d.txt' % i))
+    # plus one really deep chain
+    chain = os.path.join(source, 'deep', *(['chain'] * 30))
+    os.makedirs(chain)
+    write(os.path.join(chain, 'bottom.txt'))
+
+    os.makedirs(os.path.join(source, 'links'))
+    for i in range(links):
+        os.symlink(os.path.join(os.pardir, 'wide', 'f%06d.dat' % (i % wide)),
+                   os.path.join(source, 'links', 'l%06d.dat' % i))
+
+    os.makedirs(os.path.join(artwork, 'skins'))
+    for i in range(skins):
+        write(os.path.join(artwork, 'skins', 's%06d.png' % i))
+
+    os.makedirs(os.path.join(build, 'bin'))
+    build_names = ['b%06d.so' % i for i in range(built)]
+    for name in build_names:
+        write(os.path.join(build, 'bin', name))
+
+    args = dict(source=source, artwork=artwork, build=build,
+                dest=os.path.join(root, 'dest'),
+                grid='default', platform='linux', arch='x86_64',
+                version=['1', '2', '3', '4'], configuration='Release',
+                buildtype='Release', channel='Second Life Test',
+                build_names=build_names)
+    # deep is copied twice: by path() and by copy_action()
+    expected = wide + 2 * (deep + 1) + links + skins + built
+    return args, expected
+
+def make_package_tree(root, count):
+    """
+    Create a tree of roughly count/10 files of 64KB each under root whose
+    contents compress about as well as a viewer install tree's: runs of
+    text and of repeated binary chunks among incompressible noise. Returns
+    the total size.
+    """
+    rng = random.Random(count)
+    chunks = [rng.randbytes(4096) for i in range(16)]
+    text = b''.join(b'viewer_symbol_%d %x\n' % (i, i * 7919) for i in range(4096))
+    total = 0
+    for i in range(max(1, count // 10)):
+        dir = os.path.join(root, 'p%02d' % (i % 32))
+        os.makedirs(dir, exist_ok=True)
+        data = bytearray()
+        while len(data) < 65536:
+            kind = rng.random()
+            if kind < 0.4:
+                start = rng.randrange(len(text) - 4096)
+                data += text[start:start + 4096]
+            elif kind < 0.8:
+                data += rng.choice(chunks)
+            else:
+                data += rng.randbytes(4096)
+        with open(os.path.join(dir, 'f%06d.so' % i), 'wb') as f:
+            f.write(data)
+        total += len(data)
+    return total
+
+class Measurement(object):
+    """
+    Context manager measuring wall time, calls to the COUNTED_CALLS os
+    functions, read/write syscalls (from /proc/self/io, where there is
+    one) and peak RSS over the body of the 'with' statement. Peak RSS is
+    only the body's own where reset_peak_rss() works (Linux); elsewhere
+    it's the whole process's high-water mark so far, and labelled so.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = dict.fromkeys(COUNTED_CALLS, 0)
+        # size of whatever the body produced, if the caller fills it in
+        self.output_bytes = None
+
+    def __enter__(self):
+        self.saved = {}
+        for name in COUNTED_CALLS:
+            func = getattr(os, name)
+            self.saved[name] = func
+            setattr(os, name, self.counter(name, func))
+        self.io = read_proc_io()
+        self.peak_rss_cumulative = not reset_peak_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def counter(self, name, func):
+        def counted(*args, **kwds):
+            self.calls[name] += 1
+            return func(*args, **kwds)
+        return counted
+
+    def __exit__(self, type, value, tb):
+        self.seconds = time.perf_counter() - self.start
+        for name, func in self.saved.items():
+            setattr(os, name, func)
+        io = read_proc_io()
+        self.syscalls = None
+        if io and self.io:
+            self.syscalls = (io['syscr'] - self.io['syscr']) + (io['syscw'] - self.io['syscw'])
+        self.peak_rss = peak_rss()
+        return False
+
+    def as_json(self):
+        return dict(name=self.name, files=SCALE, seconds=self.seconds,
+                    os_calls=sum(self.calls.values()), calls=self.calls,
+                    rw_syscalls=self.syscalls, peak_rss=self.peak_rss,
+                    peak_rss_cumulative=self.peak_rss_cumulative,
+                    output_bytes=self.output_bytes)
+
+    def __str__(self):
+        calls = ', '.join('%s %s' % (name, count)
+                          for name, count in sorted(self.calls.items()) if count)
+        result = "%-16s %8.3fs  os calls: %s  read/write syscalls: %s  %s: %s" % \
+                 (self.name, self.seconds, calls or 'none',
+                  'n/a' if self.syscalls is None else self.syscalls,
+                  'process peak RSS' if self.peak_rss_cumulative else 'peak RSS',
+                  'n/a' if self.peak_rss is None else llmanifest.format_size(self.peak_rss))
+        if self.output_bytes is not None:
+            result += "  output: %s" % llmanifest.format_size(self.output_bytes)
+        return result
+
+def read_proc_io():
+    try:
+        with open('/proc/self/io') as f:
+            return dict((key, int(value)) for key, value in
+                        (line.split(':') for line in f if ':' in line))
+    except (IOError, ValueError):
+        return None
+
+def reset_peak_rss():
+    """
+    Start peak_rss() counting afresh, where the platform allows it (Linux,
+    by writing 5 to /proc/self/clear_refs). Returns False if it doesn't.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return read_vm_hwm() is not None
+    except IOError:
+        return False
+
+def read_vm_hwm():
+    """The VmHWM (peak RSS) line of /proc/self/status, in bytes, or None."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+def peak_rss():
+    rss = read_vm_hwm()
+    if rss is not None or resource is None:
+        return rss
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, except on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+def last_baseline(name):
+    """Seconds recorded for scenario name in LLMANIFEST_BENCH_BASELINE, or None."""
+    path = os.environ.get('LLMANIFEST_BENCH_BASELINE')
+    if not path:
+        return None
+    seconds = None
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['name'] == name and record['files'] == SCALE:
+                seconds = record['seconds']
+    return seconds
+
+class TestLLManifestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='llmanifest-bench-')
+        self.args, self.expected = make_trees(self.tempdir, SCALE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def run_manifest(self, name, *actions, **args):
+        manifest = BenchmarkManifest(dict(self.args, **args))
+        with contextlib.redirect_stdout(io.StringIO()):
+            with Measurement(name) as measurement:
+                manifest.do(*actions)
+        print(measurement)
+        self.record(measurement)
+        return manifest
+
+    def record(self, measurement):
+        output = os.environ.get('LLMANIFEST_BENCH_OUTPUT')
+        if output:
+            with open(output, 'a') as f:
+                f.write(json.dumps(measurement.as_json()) + '\n')
+        baseline = last_baseline(measurement.name)
+        if baseline is not None:
+            tolerance = float(os.environ.get('LLMANIFEST_BENCH_TOLERANCE', '0.5'))
+            self.assertLessEqual(measurement.seconds, baseline * (1 + tolerance),
+                                 "%s took %.3fs, baseline %.3fs" %
+                                 (measurement.name, measurement.seconds, baseline))
+
+    def count_dest_files(self):
+        return sum(len(files) for dirpath, dirnames, files in os.walk(self.args['dest']))
+
+    def test_copy(self):
+        self.run_manifest('copy', 'copy')
+        self.assertEqual(self.count_dest_files(), self.expected)
+        # nothing has changed, so this should be a great deal cheaper
+        self.run_manifest('copy (no-op)', 'copy')
+        self.assertEqual(self.count_dest_files(), self.expected)
+
+    def test_copy_parallel(self):
+        self.run_manifest('copy (4 jobs)', 'copy', copy_jobs='4')
+        self.assertEqual(self.count_dest_files(), self.expected)
+
+    def test_unpacked(self):
+        self.run_manifest('copy', 'copy')
+        self.run_manifest('unpacked', 'copy', 'unpacked')
+        tarballs = [name for name in os.listdir(self.args['source'])
+                    if name.startswith('unpacked_') and name.endswith('.tar')]
+        self.assertEqual(len(tarballs), 1)
+        # everything in the destination tree, however it got there
+        with tarfile.open(os.path.join(self.args['source'], tarballs[0])) as tf:
+            members = sorted(info.name for info in tf)
+        dest = self.args['dest']
+        expected = sorted(os.path.relpath(os.path.join(dirpath, name), dest).replace(os.sep, '/')
+                          for dirpath, dirnames, files in os.walk(dest)
+                          for name in dirnames + files)
+        self.assertEqual(members, expected)
+
+    def test_package_compression(self):
+        top = os.environ.get('LLMANIFEST_BENCH_PACKAGE')
+        if not top:
+            top = os.path.join(self.tempdir, 'package')
+            make_package_tree(top, SCALE)
+        members = list(llmanifest.tree_members(top, 'package'))
+        output = os.path.join(self.tempdir, 'package.tar')
+
+        # what LinuxManifest.package_finish() used to do
+        reference = None
+        if shutil.which('tar') and shutil.which('bzip2'):
+            with Measurement('package tar -cj') as measurement:
+                subprocess.check_call(['tar', '-C', top, '--numeric-owner',
+                                       '-cjf', output + '.bz2', '.'])
+            measurement.output_bytes = os.path.getsize(output + '.bz2')
+            print(measurement)
+            self.record(measurement)
+            reference = measurement.seconds
+
+        for codec in sorted(llmanifest.TARBALL_CODECS):
+            if codec == 'zstd' and not shutil.which('zstd'):
+                try:
+                    import zstandard
+                except ImportError:
+                    continue
+            filename = output + llmanifest.tarball_extension(codec)
+            with Measurement('package ' + codec) as measurement:
+                llmanifest.write_tarball(filename, members, codec,
+                                         mtime=0, normal_modes=True)
+            measurement.output_bytes = os.path.getsize(filename)
+            print(measurement, end='')
+            print("  speedup: %.1fx" % (reference / measurement.seconds)
+                  if reference else '')
+            self.record(measurement)
+            self.assertGreater(measurement.output_bytes, 0)
+
+        # the same tree makes the same tarball, whatever its timestamps
+        with open(output, 'rb') as f:
+            first = f.read()
+        os.utime(members[-1][0], (0, 0))
+        llmanifest.write_tarball(output, members, 'none', mtime=0, normal_modes=True)
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), first)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""\
+@file test_viewer_manifest.py
+@brief Tests for ViewerManifest helpers, against small scratch trees.
+
+$LicenseInfo:firstyear=2026&license=viewerlgpl$
+Second Life Viewer Source Code
+Copyright (C) 2026, Linden Research, Inc.
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation;
+version 2.1 of the License only.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+Linden Research, Inc., 945 Battery Street, San Francisco, CA  94111  USA
+$/LicenseInfo$
+"""
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(__file__))
+import viewer_manifest
+from viewer_manifest import LLManifest
+
+class LinkingManifest(viewer_manifest.ViewerManifest):
+    """
+    Links to a copied framework the way DarwinManifest.construct() does,
+    without the rest of a viewer.
+    """
+    def construct(self):
+        LLManifest.construct(self)
+        with self.prefix(dst='Frameworks'):
+            self.path('CEF.framework')
+        with self.prefix(dst='Resources'):
+            self.relsymlinkf(self.dst_path_of(os.path.join(os.pardir, 'Frameworks', 'CEF.framework')),
+                             catch=False)
+            self.symlinkf('CEF.framework', 'Alias', catch=False)
+
+class TestSymlinkf(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='viewer-manifest-test-')
+        self.source = os.path.join(self.tempdir, 'source')
+        self.dest = os.path.join(self.tempdir, 'dest')
+        framework = os.path.join(self.source, 'CEF.framework')
+        os.makedirs(framework)
+        with open(os.path.join(framework, 'CEF'), 'wb') as f:
+            f.write(b'cef')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def run_manifest(self, *actions, **args):
+        manifest = LinkingManifest(dict(dict(
+            source=self.source, artwork=self.source, build=self.source,
+            dest=self.dest, grid='default', platform='darwin', arch='x86_64',
+            version=['1', '2', '3', '4'], configuration='Release',
+            buildtype='Release', channel='Second Life Test', actions=actions), **args))
+        with contextlib.redirect_stdout(io.StringIO()):
+            manifest.do(*actions)
+        return manifest
+
+    def links(self):
+        resources = os.path.join(self.dest, 'Resources')
+        return dict((name, os.readlink(os.path.join(resources, name)))
+                    for name in sorted(os.listdir(resources)))
+
+    def test_copy(self):
+        self.run_manifest('copy')
+        self.assertEqual(self.links(), {'Alias': 'CEF.framework',
+                                        'CEF.framework': '../Frameworks/CEF.framework'})
+        # again, over the links already there
+        self.run_manifest('copy')
+        self.assertEqual(len(self.links()), 2)
+
+    def test_check_touches_nothing(self):
+        self.run_manifest('check')
+        self.assertFalse(os.path.exists(self.dest))
+
+    def test_plan_touches_nothing(self):
+        plan = os.path.join(self.tempdir, 'plan.json')
+        self.run_manifest('copy', 'plan', plan=plan)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertTrue(os.path.exists(plan))
+
+    def test_executed_plan(self):
+        self.run_manifest('copy', plan=os.path.join(self.tempdir, 'plan.json'))
+        self.assertEqual(self.links(), {'Alias': 'CEF.framework',
+                                        'CEF.framework': '../Frameworks/CEF.framework'})
+        with open(os.path.join(self.dest, 'Resources', 'Alias', 'CEF'), 'rb') as f:
+            self.assertEqual(f.read(), b'cef')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""\
+@file test_viewer_manifest_benchmark.py
+@brief Benchmark for WindowsManifest's NSIS file-command generation.
+
+That's pure path logic, so this runs anywhere, not just on Windows. Run with
+pytest (or directly). VIEWER_MANIFEST_BENCH_FILES sets the number of files
+(default 50000).
+
+$LicenseInfo:firstyear=2026&license=viewerlgpl$
+Second Life Viewer Source Code
+Copyright (C) 2026, Linden Research, Inc.
+
+This library is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation;
+version 2.1 of the License only.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+Linden Research, Inc., 945 Battery Street, San Francisco, CA  94111  USA
+$/LicenseInfo$
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(__file__))
+import viewer_manifest
+from viewer_manifest import path_ancestors
+
+SCALE = int(os.environ.get('VIEWER_MANIFEST_BENCH_FILES', '50000'))
+
+def legacy_nsi_file_commands(manifest, install=True):
+    """
+    What WindowsManifest.nsi_file_commands() used to be, to check the new
+    one against and to time it against.
+    """
+    def wpath(path):
+        if path.endswith('/') or path.endswith(os.path.sep):
+            path = path[:-1]
+        path = path.replace('/', '\\')
+        return path
+
+    result = ""
+    dest_files = [pair[1] for pair in manifest.file_list if pair[0] and os.path.isfile(pair[1])]
+    # sort deepest hierarchy first
+    dest_files.sort(key=lambda f: (f.count(os.path.sep), f), reverse=True)
+    out_path = None
+    for pkg_file in dest_files:
+        rel_file = os.path.normpath(pkg_file.replace(manifest.get_dst_prefix()+os.path.sep,''))
+        installed_dir = wpath(os.path.join('$INSTDIR', os.path.dirname(rel_file)))
+        pkg_file = wpath(os.path.normpath(pkg_file))
+        if installed_dir != out_path:
+            if install:
+                out_path = installed_dir
+                result += 'SetOutPath ' + out_path + '\n'
+        if install:
+            result += 'File ' + pkg_file + '\n'
+        else:
+            result += 'Delete ' + wpath(os.path.join('$INSTDIR', rel_file)) + '\n'
+
+    # at the end of a delete, just rmdir all the directories
+    if not install:
+        deleted_file_dirs = [os.path.dirname(pair[1].replace(manifest.get_dst_prefix()+os.path.sep,'')) for pair in manifest.file_list]
+        # find all ancestors so that we don't skip any dirs that happened to have no non-dir children
+        deleted_dirs = []
+        for d in deleted_file_dirs:
+            deleted_dirs.extend(path_ancestors(d))
+        # sort deepest hierarchy first
+        deleted_dirs.sort(key=lambda f: (f.count(os.path.sep), f), reverse=True)
+        prev = None
+        for d in deleted_dirs:
+            if d != prev:   # skip duplicates
+                result += 'RMDir ' + wpath(os.path.join('$INSTDIR', os.path.normpath(d))) + '\n'
+            prev = d
+
+    return result
+
+def make_manifest(root, count):
+    """
+    A Windows_x86_64_Manifest whose file_list holds count files (which
+    exist, empty, in its destination tree) in a few hundred directories
+    of varying depth, plus the sorts of entry that aren't packaged: a
+    directory, a missing file and generated output with no source.
+    """
+    source = os.path.join(root, 'source')
+    dest = os.path.join(root, 'dest')
+    os.makedirs(source)
+    manifest = viewer_manifest.Windows_x86_64_Manifest(dict(
+        source=source, artwork=source, build=source, dest=dest,
+        grid='default', platform='windows', arch='x86_64',
+        version=['1', '2', '3', '4'], configuration='Release',
+        buildtype='Release', channel='Second Life Test'))
+    for i in range(count):
+        dir = os.path.join(dest, *('d%d' % (i % n) for n in (3, 7, 11)[:i % 4]))
+        os.makedirs(dir, exist_ok=True)
+        dst = os.path.join(dir, 'f%06d.dll' % i)
+        open(dst, 'wb').close()
+        manifest.file_list.append([os.path.join(source, 'f%06d.dll' % i), dst])
+    os.makedirs(os.path.join(dest, 'empty', 'dir'))
+    manifest.file_list.append([source, os.path.join(dest, 'empty', 'dir')])
+    manifest.file_list.append([os.path.join(source, 'gone'), os.path.join(dest, 'gone', 'file')])
+    manifest.file_list.append([None, os.path.join(dest, 'd1', 'generated.txt')])
+    return manifest
+
+class TestNSIFileCommands(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='viewer-manifest-bench-')
+        self.manifest = make_manifest(self.tempdir, SCALE)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_nsi_file_commands(self):
+        start = time.perf_counter()
+        expected = [legacy_nsi_file_commands(self.manifest, install)
+                    for install in (True, False)]
+        legacy = time.perf_counter() - start
+
+        start = time.perf_counter()
+        entries = self.manifest.nsi_file_entries()
+        actual = [''.join(self.manifest.nsi_file_commands(install, entries))
+                  for install in (True, False)]
+        seconds = time.perf_counter() - start
+
+        print("nsi_file_commands, %d files: %.3fs (was %.3fs)" % (SCALE, seconds, legacy))
+        self.assertEqual(actual, expected)
+        self.assertEqual(actual[0].count('\nFile '), SCALE)
+
+    def test_replace_in(self):
+        with open(os.path.join(self.manifest.get_src_prefix(), 'template.nsi'), 'w') as f:
+            f.write("%%VERSION%%\n%%INSTALL_FILES%%\nSection Uninstall\n%%DELETE_FILES%%\n%%INSTALL_FILES%%")
+        entries = self.manifest.nsi_file_entries()
+        self.manifest.replace_in('template.nsi', 'out.nsi', {
+            '%%VERSION%%': '!define VERSION "1.2.3"',
+            '%%INSTALL_FILES%%': self.manifest.nsi_file_commands(True, entries),
+            '%%DELETE_FILES%%': self.manifest.nsi_file_commands(False, entries)})
+        install, delete = [legacy_nsi_file_commands(self.manifest, install)
+                           for install in (True, False)]
+        with open(self.manifest.dst_path_of('out.nsi')) as f:
+            self.assertEqual(f.read(), '!define VERSION "1.2.3"\n%s\nSection Uninstall\n%s\n%s'
+                             % (install, delete, install))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -48,7 +48,7 @@ viewer_dir = os.path.dirname(__file__)
 # Put it FIRST because some of our build hosts have an ancient install of
 # indra.util.llmanifest under their system Python!
 sys.path.insert(0, os.path.join(viewer_dir, os.pardir, "lib", "python"))
-from indra.util.llmanifest import LLManifest, main, path_ancestors, CHANNEL_VENDOR_BASE, RELEASE_CHANNEL, ManifestError, MissingError
+from indra.util.llmanifest import LLManifest, main, path_ancestors, normalize_modes, tarball_extension, tree_members, write_tarball, CHANNEL_VENDOR_BASE, RELEASE_CHANNEL, ManifestError, MissingError
 
 try:
     import llsd
@@ -57,6 +57,18 @@ except:
     LLBASE_IMPORTED=False
     
 class ViewerManifest(LLManifest):
+    # CEF locale resource files, shipped by both Windows and Linux viewers
+    cef_locales = (
+        "am.pak", "ar.pak", "bg.pak", "bn.pak", "ca.pak", "cs.pak", "da.pak",
+        "de.pak", "el.pak", "en-GB.pak", "en-US.pak", "es-419.pak", "es.pak",
+        "et.pak", "fa.pak", "fi.pak", "fil.pak", "fr.pak", "gu.pak", "he.pak",
+        "hi.pak", "hr.pak", "hu.pak", "id.pak", "it.pak", "ja.pak", "kn.pak",
+        "ko.pak", "lt.pak", "lv.pak", "ml.pak", "mr.pak", "ms.pak", "nb.pak",
+        "nl.pak", "pl.pak", "pt-BR.pak", "pt-PT.pak", "ro.pak", "ru.pak",
+        "sk.pak", "sl.pak", "sr.pak", "sv.pak", "sw.pak", "ta.pak", "te.pak",
+        "th.pak", "tr.pak", "uk.pak", "vi.pak", "zh-CN.pak", "zh-TW.pak",
+        )
+
     def is_packaging_viewer(self):
         # Some commands, files will only be included
         # if we are packaging the viewer on windows.
@@ -357,38 +369,10 @@ class ViewerManifest(LLManifest):
         if os.path.isabs(src):
             raise ManifestError("Do not symlinkf(absolute %r, asis=True)" % src)
 
-        # The outer catch is the one that reports failure even after attempted
-        # recovery.
+        # make_symlink() replaces whatever else is at dst (or, while
+        # planning, just records the link); this reports failure.
         try:
-            # At the inner layer, recovery may be possible.
-            try:
-                os.symlink(src, dst)
-            except OSError as err:
-                if err.errno != errno.EEXIST:
-                    raise
-                # We could just blithely attempt to remove and recreate the target
-                # file, but that strategy doesn't work so well if we don't have
-                # permissions to remove it. Check to see if it's already the
-                # symlink we want, which is the usual reason for EEXIST.
-                elif os.path.islink(dst):
-                    if os.readlink(dst) == src:
-                        # the requested link already exists
-                        pass
-                    else:
-                        # dst is the wrong symlink; attempt to remove and recreate it
-                        os.remove(dst)
-                        os.symlink(src, dst)
-                elif os.path.isdir(dst):
-                    print("Requested symlink (%s) exists but is a directory; replacing" % dst)
-                    shutil.rmtree(dst)
-                    os.symlink(src, dst)
-                elif os.path.exists(dst):
-                    print("Requested symlink (%s) exists but is a file; replacing" % dst)
-                    os.remove(dst)
-                    os.symlink(src, dst)
-                else:
-                    # out of ideas
-                    raise
+            self.make_symlink(src, dst)
         except Exception as err:
             # report
             print("Can't symlink %r -> %r: %s: %s" % \
@@ -626,59 +610,7 @@ class WindowsManifest(ViewerManifest):
                 self.path("icudtl.dat")
 
             with self.prefix(src=os.path.join(pkgdir, 'resources', 'locales'), dst='locales'):
-                self.path("am.pak")
-                self.path("ar.pak")
-                self.path("bg.pak")
-                self.path("bn.pak")
-                self.path("ca.pak")
-                self.path("cs.pak")
-                self.path("da.pak")
-                self.path("de.pak")
-                self.path("el.pak")
-                self.path("en-GB.pak")
-                self.path("en-US.pak")
-                self.path("es-419.pak")
-                self.path("es.pak")
-                self.path("et.pak")
-                self.path("fa.pak")
-                self.path("fi.pak")
-                self.path("fil.pak")
-                self.path("fr.pak")
-                self.path("gu.pak")
-                self.path("he.pak")
-                self.path("hi.pak")
-                self.path("hr.pak")
-                self.path("hu.pak")
-                self.path("id.pak")
-                self.path("it.pak")
-                self.path("ja.pak")
-                self.path("kn.pak")
-                self.path("ko.pak")
-                self.path("lt.pak")
-                self.path("lv.pak")
-                self.path("ml.pak")
-                self.path("mr.pak")
-                self.path("ms.pak")
-                self.path("nb.pak")
-                self.path("nl.pak")
-                self.path("pl.pak")
-                self.path("pt-BR.pak")
-                self.path("pt-PT.pak")
-                self.path("ro.pak")
-                self.path("ru.pak")
-                self.path("sk.pak")
-                self.path("sl.pak")
-                self.path("sr.pak")
-                self.path("sv.pak")
-                self.path("sw.pak")
-                self.path("ta.pak")
-                self.path("te.pak")
-                self.path("th.pak")
-                self.path("tr.pak")
-                self.path("uk.pak")
-                self.path("vi.pak")
-                self.path("zh-CN.pak")
-                self.path("zh-TW.pak")
+                self.path_many(self.cef_locales)
 
             with self.prefix(src=os.path.join(pkgdir, 'bin', 'release')):
                 self.path("libvlc.dll")
@@ -688,47 +620,89 @@ class WindowsManifest(ViewerManifest):
         if not self.is_packaging_viewer():
             self.package_file = "copied_deps"    
 
-    def nsi_file_commands(self, install=True):
+    def nsi_file_entries(self):
+        """
+        Work out, once, what nsi_file_commands() needs to know about
+        file_list, in NSIS's (backslashed) form: for each file, deepest
+        directories first, its installed directory, its installed path
+        and its packaged path; and every directory under $INSTDIR holding
+        anything from file_list, deepest first.
+        """
         def wpath(path):
             if path.endswith('/') or path.endswith(os.path.sep):
                 path = path[:-1]
             path = path.replace('/', '\\')
             return path
 
-        result = ""
-        dest_files = [pair[1] for pair in self.file_list if pair[0] and os.path.isfile(pair[1])]
+        def nsi_paths(dst):
+            rel_path = dst.replace(prefix, '')
+            rel_file = os.path.normpath(rel_path)
+            return (os.path.dirname(rel_path),
+                    wpath(os.path.join('$INSTDIR', os.path.dirname(rel_file))),
+                    wpath(os.path.join('$INSTDIR', rel_file)),
+                    wpath(os.path.normpath(dst)))
+
+        prefix = self.get_dst_prefix() + os.path.sep
+        files = []
+        dirnames = set()
+        # Most directories hold many files, whose paths differ only in the
+        # last component: work each directory's out just once.
+        dir_paths = {}
+        for src, dst in self.file_list:
+            dir, base = os.path.split(dst)
+            if base in ('', os.curdir, os.pardir):
+                paths = nsi_paths(dst)
+            else:
+                paths = dir_paths.get(dir)
+                if paths is None:
+                    rel_dir, installed_dir, installed_file, pkg_file = nsi_paths(dst)
+                    paths = dir_paths[dir] = (rel_dir, installed_dir,
+                                              installed_file[:-len(base)], pkg_file[:-len(base)])
+                paths = paths[:2] + (paths[2] + base, paths[3] + base)
+            dirnames.add(paths[0])
+            if not src:
+                continue
+            kind = self.path_kind(dst)
+            if kind != 'file' and not (kind == 'link' and os.path.isfile(dst)):
+                continue
+            files.append((dst.count(os.path.sep), dst) + paths[1:])
         # sort deepest hierarchy first
-        dest_files.sort(key=lambda f: (f.count(os.path.sep), f), reverse=True)
-        out_path = None
-        for pkg_file in dest_files:
-            rel_file = os.path.normpath(pkg_file.replace(self.get_dst_prefix()+os.path.sep,''))
-            installed_dir = wpath(os.path.join('$INSTDIR', os.path.dirname(rel_file)))
-            pkg_file = wpath(os.path.normpath(pkg_file))
-            if installed_dir != out_path:
-                if install:
+        files.sort(reverse=True)
+
+        # find all ancestors so that we don't skip any dirs that happened to
+        # have no non-dir children; once we reach one we've seen, we've seen
+        # all of its ancestors too
+        dirs = set()
+        for dirname in dirnames:
+            for ancestor in path_ancestors(dirname):
+                if ancestor in dirs:
+                    break
+                dirs.add(ancestor)
+        dirs = [wpath(os.path.join('$INSTDIR', d))
+                for d in sorted(dirs, key=lambda f: (f.count(os.path.sep), f), reverse=True)]
+
+        return [entry[2:] for entry in files], dirs
+
+    def nsi_file_commands(self, install=True, entries=None):
+        """
+        Generate, a line at a time, the NSIS commands to install (or, if not
+        install, delete) every file in file_list. Pass entries from
+        nsi_file_entries() to reuse them for both.
+        """
+        files, dirs = entries or self.nsi_file_entries()
+        if install:
+            out_path = None
+            for installed_dir, installed_file, pkg_file in files:
+                if installed_dir != out_path:
                     out_path = installed_dir
-                    result += 'SetOutPath ' + out_path + '\n'
-            if install:
-                result += 'File ' + pkg_file + '\n'
-            else:
-                result += 'Delete ' + wpath(os.path.join('$INSTDIR', rel_file)) + '\n'
-
-        # at the end of a delete, just rmdir all the directories
-        if not install:
-            deleted_file_dirs = [os.path.dirname(pair[1].replace(self.get_dst_prefix()+os.path.sep,'')) for pair in self.file_list]
-            # find all ancestors so that we don't skip any dirs that happened to have no non-dir children
-            deleted_dirs = []
-            for d in deleted_file_dirs:
-                deleted_dirs.extend(path_ancestors(d))
-            # sort deepest hierarchy first
-            deleted_dirs.sort(key=lambda f: (f.count(os.path.sep), f), reverse=True)
-            prev = None
-            for d in deleted_dirs:
-                if d != prev:   # skip duplicates
-                    result += 'RMDir ' + wpath(os.path.join('$INSTDIR', os.path.normpath(d))) + '\n'
-                prev = d
-
-        return result
+                    yield 'SetOutPath ' + out_path + '\n'
+                yield 'File ' + pkg_file + '\n'
+        else:
+            for installed_dir, installed_file, pkg_file in files:
+                yield 'Delete ' + installed_file + '\n'
+            # at the end of a delete, just rmdir all the directories
+            for d in dirs:
+                yield 'RMDir ' + d + '\n'
 
     def package_finish(self):
         # a standard map of strings for replacing in the templates
@@ -776,6 +750,7 @@ class WindowsManifest(ViewerManifest):
             engage_registry="SetRegView 32"
             program_files=""
 
+        nsi_files = self.nsi_file_entries()
         tempfile = "secondlife_setup_tmp.nsi"
         # the following replaces strings in the nsi template
         # it also does python-style % substitution
@@ -783,10 +758,10 @@ class WindowsManifest(ViewerManifest):
                 "%%VERSION%%":version_vars,
                 "%%SOURCE%%":self.get_src_prefix(),
                 "%%INST_VARS%%":inst_vars_template % substitution_strings,
-                "%%INSTALL_FILES%%":self.nsi_file_commands(True),
+                "%%INSTALL_FILES%%":self.nsi_file_commands(True, nsi_files),
                 "%%PROGRAMFILES%%":program_files,
                 "%%ENGAGEREGISTRY%%":engage_registry,
-                "%%DELETE_FILES%%":self.nsi_file_commands(False)})
+                "%%DELETE_FILES%%":self.nsi_file_commands(False, nsi_files)})
 
         # If we're on a build machine, sign the code using our Authenticode certificate. JC
         # note that the enclosing setup exe is signed later, after the makensis makes it.
@@ -797,6 +772,7 @@ class WindowsManifest(ViewerManifest):
             "llplugin/dullahan_host.exe",
             ):
             self.sign(exe)
+        self.package_tree_ready()
             
         # Check two paths, one for Program Files, and one for Program Files (x86).
         # Yay 64bit windows.
@@ -1369,6 +1345,9 @@ class Darwin_x86_64_Manifest(DarwinManifest):
 
 class LinuxManifest(ViewerManifest):
     build_data_json_platform = 'lnx'
+    # The CEF resources and swiftshader libraries go into both bin/ and lib/.
+    # The tarball preserves symlinks, so ship one copy of each.
+    dedupe_policy = 'symlink'
 
     def construct(self):
         super(LinuxManifest, self).construct()
@@ -1446,59 +1425,7 @@ class LinuxManifest(ViewerManifest):
             self.path( "icudtl.dat" )
 
         with self.prefix(src=os.path.join(pkgdir, 'resources', 'locales'), dst=os.path.join('bin', 'locales')):
-            self.path("am.pak")
-            self.path("ar.pak")
-            self.path("bg.pak")
-            self.path("bn.pak")
-            self.path("ca.pak")
-            self.path("cs.pak")
-            self.path("da.pak")
-            self.path("de.pak")
-            self.path("el.pak")
-            self.path("en-GB.pak")
-            self.path("en-US.pak")
-            self.path("es-419.pak")
-            self.path("es.pak")
-            self.path("et.pak")
-            self.path("fa.pak")
-            self.path("fi.pak")
-            self.path("fil.pak")
-            self.path("fr.pak")
-            self.path("gu.pak")
-            self.path("he.pak")
-            self.path("hi.pak")
-            self.path("hr.pak")
-            self.path("hu.pak")
-            self.path("id.pak")
-            self.path("it.pak")
-            self.path("ja.pak")
-            self.path("kn.pak")
-            self.path("ko.pak")
-            self.path("lt.pak")
-            self.path("lv.pak")
-            self.path("ml.pak")
-            self.path("mr.pak")
-            self.path("ms.pak")
-            self.path("nb.pak")
-            self.path("nl.pak")
-            self.path("pl.pak")
-            self.path("pt-BR.pak")
-            self.path("pt-PT.pak")
-            self.path("ro.pak")
-            self.path("ru.pak")
-            self.path("sk.pak")
-            self.path("sl.pak")
-            self.path("sr.pak")
-            self.path("sv.pak")
-            self.path("sw.pak")
-            self.path("ta.pak")
-            self.path("te.pak")
-            self.path("th.pak")
-            self.path("tr.pak")
-            self.path("uk.pak")
-            self.path("vi.pak")
-            self.path("zh-CN.pak")
-            self.path("zh-TW.pak")
+            self.path_many(self.cef_locales)
 
         self.path("featuretable_linux.txt")
         self.path("cube.dae")
@@ -1508,19 +1435,30 @@ class LinuxManifest(ViewerManifest):
 
     def package_finish(self):
         installer_name = self.installer_base_name()
+        codec = self.args.get('package_compression', 'bz2')
+        package_file = installer_name + '.tar' + tarball_extension(codec)
+        tarball = self.build_path_of(package_file)
+
+        # If nothing that goes into the tarball has changed since we last
+        # built it, don't strip, chmod and compress all over again.
+        if "FLATPAK_DEST" not in os.environ and \
+           self.args['buildtype'].lower() == 'release' and \
+           self.artifact_is_current(tarball):
+            print("%s is up to date" % tarball)
+            self.package_file = package_file
+            self.package_tree_ready(changed=False)
+            return
 
         self.strip_binaries()
 
         # Fix access permissions
-        self.run_command(['find', self.get_dst_prefix(),
-                          '-type', 'd', '-exec', 'chmod', '755', '{}', ';'])
-        for old, new in ('0700', '0755'), ('0500', '0555'), ('0600', '0644'), ('0400', '0444'):
-            self.run_command(['find', self.get_dst_prefix(),
-                              '-type', 'f', '-perm', old,
-                              '-exec', 'chmod', new, '{}', ';'])
+        changed = normalize_modes(self.get_dst_prefix(), 0o755,
+                                  {0o700: 0o755, 0o500: 0o555, 0o600: 0o644, 0o400: 0o444})
+        print("Fixed access permissions of %d files and directories" % changed)
+        # report sizes of the stripped tree
+        self.package_tree_ready()
 
         realname = self.get_dst_prefix()
-        tempname = self.build_path_of(installer_name)
         if "FLATPAK_DEST" in os.environ:
             flatpakDest = os.environ["FLATPAK_DEST"] 
             print( "Moving result into %s" % flatpakDest )
@@ -1528,24 +1466,25 @@ class LinuxManifest(ViewerManifest):
             self.package_file = flatpakDest
             return
             
-        self.package_file = installer_name + '.tar.bz2'
-
-        # temporarily move directory tree so that it has the right
-        # name in the tarfile
-        self.run_command(["mv", realname, tempname])
-        try:
-            # only create tarball if it's a release build.
-            if self.args['buildtype'].lower() == 'release':
-                # --numeric-owner hides the username of the builder for
-                # security etc.
-                self.run_command(['tar', '-C', self.get_build_prefix(),
-                                  '--numeric-owner', '-cjf',
-                                 tempname + '.tar.bz2', installer_name])
-            else:
-                print("Skipping %s.tar.bz2 for non-Release build (%s)" % \
-                      (installer_name, self.args['buildtype']))
-        finally:
-            self.run_command(["mv", tempname, realname])
+        self.package_file = package_file
+
+        # only create tarball if it's a release build.
+        if self.args['buildtype'].lower() == 'release':
+            self.forget_artifact(tarball)
+            # Stream the tree straight into the tarball under installer_name,
+            # in sorted order, with owner, mtime and permissions normalized
+            # (no builder's username, as with tar --numeric-owner), so that
+            # the same tree always makes the same bytes. Every member is
+            # dated $SOURCE_DATE_EPOCH if set, else as the newest input.
+            epoch = os.environ.get('SOURCE_DATE_EPOCH')
+            mtime = int(epoch) if epoch else self.newest_input_mtime()
+            with self.tracing('compress', codec=codec):
+                write_tarball(tarball, tree_members(realname, installer_name),
+                              codec, mtime=mtime, normal_modes=True)
+            self.record_artifact(tarball)
+        else:
+            print("Skipping %s for non-Release build (%s)" % \
+                  (package_file, self.args['buildtype']))
 
     def strip_binaries(self):
         doStrip = False
@@ -1558,17 +1497,7 @@ class LinuxManifest(ViewerManifest):
         if doStrip:
             print("* Going strip-crazy on the packaged binaries, since this is a Release build")
             # makes some small assumptions about our packaged dir structure
-            self.run_command(
-                ["find"] +
-                [os.path.join(self.get_dst_prefix(), dir) for dir in ('bin', 'lib')] +
-                ['-type', 'f', '!', '-name', '*.py',
-                 '!', '-name', '*.pak',
-                 '!', '-name', '*.bin',
-                 '!', '-name', '*.dat',
-                 '!', '-name', '*.crt',
-                 '!', '-name', '*.dll',
-                 '!', '-name', '*.lib',
-                 '!', '-name', 'update_install', '-exec', 'strip', '-S', '{}', ';'])
+            self.strip_debug_info(['bin', 'lib'])
 
 class Linux_x86_64_Manifest(LinuxManifest):
     address_size = 64
@@ -1586,12 +1515,12 @@ class Linux_x86_64_Manifest(LinuxManifest):
         relpkgdir = os.path.join(pkgdir, "lib", "release")
         debpkgdir = os.path.join(pkgdir, "lib", "debug")
         with self.prefix(src=relpkgdir, dst="lib"):
-            self.path("libapr-1.so")
-            self.path("libapr-1.so.0")
-            self.path("libapr-1.so.0.4.5")
-            self.path("libaprutil-1.so")
-            self.path("libaprutil-1.so.0")
-            self.path("libaprutil-1.so.0.4.1")
+            self.path_many(["libapr-1.so",
+                            "libapr-1.so.0",
+                            "libapr-1.so.0.4.5",
+                            "libaprutil-1.so",
+                            "libaprutil-1.so.0",
+                            "libaprutil-1.so.0.4.1"])
             self.path("libexpat.so.*")
             self.path("libSDL*.so.*")
 
@@ -1603,9 +1532,9 @@ class Linux_x86_64_Manifest(LinuxManifest):
             self.path("libopenal.so", "libvivoxoal.so.1") # vivox's sdk expects this soname
             if self.args['fmodstudio'] == 'ON':
                 try:
-                    self.path("libfmod.so.11.7")
-                    self.path("libfmod.so.11")
-                    self.path("libfmod.so")
+                    self.path_many(["libfmod.so.11.7",
+                                    "libfmod.so.11",
+                                    "libfmod.so"])
                     pass
                 except:
                     print("Skipping libfmod.so - not found")